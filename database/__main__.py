@@ -1,12 +1,40 @@
-from database import models
-from database.database import engine
+import sys
+
+import click
+
+from database import migrations, models
+from database.database import SessionFactory, engine
 from logger.logger import log
 
 
 def create_tables():
     log.info("Creating tables", extra={"tag": "DB"})
     models.Base.metadata.create_all(engine)
+    migrations.upgrade(engine)
+    with SessionFactory() as session:
+        models.CourtStats.refresh(session)
+
+
+@click.group(invoke_without_command=True)
+@click.pass_context
+def cli(ctx):
+    """Without a command creates the missing tables and applies the migrations"""
+    if ctx.invoked_subcommand is None:
+        create_tables()
+
+
+@cli.command()
+def migrate():
+    """Applies the missing migrations"""
+    migrations.upgrade(engine)
+
+
+@cli.command("check-indexes")
+def check_indexes():
+    """Fails if a hot query does not read its rows in order from its index"""
+    results = migrations.check_indexes(engine)
+    sys.exit(0 if all(results.values()) else 1)
 
 
 if __name__ == "__main__":
-    create_tables()
+    cli()
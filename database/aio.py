@@ -0,0 +1,22 @@
+from sqlalchemy.engine import URL
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from database.config import DatabaseConfig
+from database.pool import engine_options, set_statement_timeout
+
+config = DatabaseConfig.from_environ()
+
+url = URL.create(
+    "postgresql+asyncpg",
+    username=config.user,
+    password=config.password,
+    host=config.host,
+    port=config.port,
+    database=config.database
+)
+
+engine = create_async_engine(url, echo=config.log_queries, future=True, **engine_options(asyncio=True))
+set_statement_timeout(engine.sync_engine)
+
+AsyncSessionFactory = sessionmaker(bind=engine, class_=AsyncSession, future=True, expire_on_commit=False)
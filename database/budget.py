@@ -0,0 +1,45 @@
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from database.config import DatabaseConfig
+from logger.logger import log
+
+config = DatabaseConfig.from_environ()
+
+local = threading.local()
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    for statements in getattr(local, "budgets", ()):
+        statements.append(statement)
+
+
+@contextmanager
+def query_budget(name: str, limit: int):
+    """
+    Counts the queries run by this thread inside the block, going over limit usually means a lazy load
+    in a loop (N+1). It is logged, or raised as QueryBudgetExceeded with TBOT_PSQL_STRICT_QUERY_BUDGET.
+    """
+    statements = []
+    if not hasattr(local, "budgets"):
+        local.budgets = []
+    local.budgets.append(statements)
+    try:
+        yield statements
+    finally:
+        local.budgets.remove(statements)
+    if len(statements) > limit:
+        message = f"{name} ran {len(statements)} queries, budget is {limit}: " + " | ".join(
+            s.split("\n", 1)[0][:80] for s in statements
+        )
+        if config.strict_query_budget:
+            raise QueryBudgetExceeded(message)
+        log.warning(message, extra={"tag": "DB"})
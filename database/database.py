@@ -1,8 +1,13 @@
-from sqlalchemy import create_engine
+import threading
+import time
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.engine import URL
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.sql.dml import UpdateBase
 
 from database.config import DatabaseConfig
+from database.pool import engine_options, set_statement_timeout
 
 config = DatabaseConfig.from_environ()
 
@@ -15,6 +20,70 @@ url = URL.create(
     database=config.database
 )
 
-engine = create_engine(url, echo=config.log_queries, future=True)
+engine = create_engine(url, echo=config.log_queries, future=True, **engine_options())
+set_statement_timeout(engine)
+
+replica_engine = None
+if config.replica_url:
+    replica_engine = create_engine(config.replica_url, echo=config.log_queries, future=True, **engine_options())
+    set_statement_timeout(replica_engine)
 
 SessionFactory = sessionmaker(bind=engine, future=True, expire_on_commit=False)
+
+
+def pool_stats() -> dict:
+    engines = {"primary": engine, "replica": replica_engine}
+    return {name: e.pool.stats() for name, e in engines.items() if e is not None}
+
+
+class RecentWrites():
+    """Keys (usually user ids) that committed a write in the last window seconds"""
+
+    def __init__(self, window: float, maxsize: int = 10000):
+        self.window = window
+        self.maxsize = maxsize
+        self.writes = {}
+        self.lock = threading.Lock()
+
+    def mark(self, key):
+        now = time.monotonic()
+        with self.lock:
+            self.writes[key] = now
+            if len(self.writes) > self.maxsize:
+                self.writes = {k: t for k, t in self.writes.items() if now - t < self.window}
+
+    def recent(self, key) -> bool:
+        with self.lock:
+            written_at = self.writes.get(key)
+        return written_at is not None and time.monotonic() - written_at < self.window
+
+
+recent_writes = RecentWrites(window=config.replica_window)
+
+
+class RoutingSession(Session):
+    """
+    Sends reads to the replica, when one is configured, and writes to the primary.
+    Once a session writes it stays on the primary, info["primary"] keeps it there from the start
+    (for check-then-write helpers). info["writer"] is the user (or any key) the session works for:
+    right after a write committed for the same key, reads go to the primary too, so the replica lag
+    never hides someone's own changes.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info["wrote"] = True
+        if replica_engine is None or self.info.get("wrote") or self.info.get("primary"):
+            return engine
+        if (writer := self.info.get("writer")) is not None and recent_writes.recent(writer):
+            return engine
+        return replica_engine
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def remember_write(session):
+    if session.info.get("wrote") and (writer := session.info.get("writer")) is not None:
+        recent_writes.mark(writer)
+
+
+RoutingSessionFactory = sessionmaker(class_=RoutingSession, future=True, expire_on_commit=False)
@@ -0,0 +1,73 @@
+import select as io_select
+import threading
+import time
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.future import select
+from sqlalchemy.pool import NullPool
+
+from database.config import DatabaseConfig
+from database.database import engine
+from logger.logger import log
+
+ACT_UPDATED = "act_updated"
+# sent by a trigger on users (migration 8), so changes made by hand in the database are seen too
+USER_UPDATED = "user_updated"
+
+# seconds between two checks of a broken listener connection
+RECONNECT_TIME = 5
+
+config = DatabaseConfig.from_environ()
+
+# behind PgBouncer in transaction pooling LISTEN needs a direct connection to PostgreSQL
+listen_engine = engine
+if config.pool.listen_url:
+    listen_engine = create_engine(config.pool.listen_url, future=True, poolclass=NullPool)
+
+
+def publish(session, channel: str, payload: str):
+    """Sends a NOTIFY delivered to the listeners when the session commits"""
+    session.execute(select(func.pg_notify(channel, payload)))
+
+
+class Listener(threading.Thread):
+    """
+    Background LISTEN on a PostgreSQL channel, callback gets the payload of every notification.
+    Notifications sent while the connection was down are lost, so after a reconnection callback
+    is called with None meaning "anything may have changed".
+    """
+
+    def __init__(self, channel: str, callback):
+        super().__init__(name=f"listener-{channel}", daemon=True)
+        self.channel = channel
+        self.callback = callback
+        self.role = "DB"
+
+    def run(self):
+        connected_before = False
+        while True:
+            conn = None
+            try:
+                conn = listen_engine.raw_connection()
+                dbapi_conn = conn.dbapi_connection
+                dbapi_conn.autocommit = True
+                dbapi_conn.cursor().execute(f"LISTEN {self.channel}")
+                log.info(f"Listening on {self.channel}", extra={"tag": self.role})
+                if connected_before:
+                    self.callback(None)
+                connected_before = True
+                self.listen(dbapi_conn)
+            except Exception:
+                log.exception(f"Listener error on {self.channel}", extra={"tag": self.role})
+                if conn is not None:
+                    conn.invalidate()
+                time.sleep(RECONNECT_TIME)
+
+    def listen(self, dbapi_conn):
+        while True:
+            if io_select.select([dbapi_conn], [], [], 60) == ([], [], []):
+                continue
+            dbapi_conn.poll()
+            while dbapi_conn.notifies:
+                notify = dbapi_conn.notifies.pop(0)
+                self.callback(notify.payload)
@@ -0,0 +1,41 @@
+"""
+Loader profiles of the hot Act queries: every path loads the columns and relationships it renders,
+in a fixed number of queries, and nothing else. full_text (in acts_text) and ActInfo.has_docs are only
+loaded on request.
+"""
+from sqlalchemy.orm import defer, joinedload, selectinload, undefer
+
+import database.models as models
+
+
+def bot_card():
+    """Act card shown by the bot: court name, extra info and the docs button"""
+    Act, ActInfo = models.Act, models.ActInfo
+    return joinedload(Act.court), joinedload(Act.info).undefer(ActInfo.has_docs)
+
+
+def sherlock_batch():
+    """Acts evaluated by Sherlock: full text, info with its docs and court for the notification text"""
+    Act, ActInfo = models.Act, models.ActInfo
+    return (
+        selectinload(Act.body),
+        joinedload(Act.court),
+        joinedload(Act.info).options(undefer(ActInfo.has_docs), selectinload(ActInfo.docs)),
+    )
+
+
+def postman_render():
+    """Acts of the messages queued without a keyboard, rendered by Postman: deeplink and docs button"""
+    Act, ActInfo = models.Act, models.ActInfo
+    return defer(Act.text), joinedload(Act.info).undefer(ActInfo.has_docs)
+
+
+PROFILES = {
+    "bot_card": bot_card,
+    "sherlock_batch": sherlock_batch,
+    "postman_render": postman_render,
+}
+
+
+def options(profile: str):
+    return PROFILES[profile]()
@@ -0,0 +1,278 @@
+"""
+Versioned schema changes for databases created before the current models.
+create_all only adds missing tables, the migrations add the columns and indexes of existing ones.
+Every step is idempotent, so on a database just created by create_all they only record the version.
+"""
+import json
+from collections import namedtuple
+
+from sqlalchemy import Float, and_, case, cast, func, insert, inspect, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.future import select
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.sql.expression import false
+
+import database.events as events
+import database.models as models
+from logger.logger import log
+
+# serializes concurrent upgrades, any constant shared by every process works
+LOCK_ID = 4242
+
+Migration = namedtuple("Migration", ["version", "description", "steps"])
+
+
+def add_column(table: str, column: str):
+    def step(conn):
+        ddl = CreateColumn(models.Base.metadata.tables[table].c[column]).compile(dialect=conn.dialect)
+        conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN IF NOT EXISTS {ddl}'))
+
+    return step
+
+
+def add_index(name: str):
+    def step(conn):
+        get_index(name).create(conn, checkfirst=True)
+
+    return step
+
+
+def add_table(table: str):
+    def step(conn):
+        models.Base.metadata.tables[table].create(conn, checkfirst=True)
+
+    return step
+
+
+def drop_column(table: str, column: str):
+    def step(conn):
+        conn.execute(text(f'ALTER TABLE "{table}" DROP COLUMN IF EXISTS {column}'))
+
+    return step
+
+
+def move_full_text(conn, batch_size: int = 500):
+    """
+    Copies acts.full_text to acts_text in batches, compressed by the column type.
+    The search vectors are computed by postgres while the plain text is still in acts.
+    """
+    if "full_text" not in {c["name"] for c in inspect(conn).get_columns("acts")}:
+        return
+    select_batch = text(
+        "SELECT a.id AS act_id, a.full_text FROM acts a "
+        "WHERE a.id > :last_id AND NOT EXISTS (SELECT 1 FROM acts_text t WHERE t.act_id = a.id) "
+        "ORDER BY a.id LIMIT :limit"
+    )
+    set_vectors = text(
+        "UPDATE acts_text t SET search_vector = "
+        "setweight(to_tsvector('italian', a.text), 'A') || setweight(to_tsvector('italian', a.full_text), 'B') "
+        "FROM acts a WHERE a.id = t.act_id AND t.act_id > :last_id AND t.act_id <= :max_id"
+    )
+    last_id, moved = 0, 0
+    while rows := conn.execute(select_batch, {"last_id": last_id, "limit": batch_size}).mappings().all():
+        conn.execute(insert(models.ActText.__table__), [dict(r) for r in rows])
+        conn.execute(set_vectors, {"last_id": last_id, "max_id": rows[-1]["act_id"]})
+        last_id = rows[-1]["act_id"]
+        moved += len(rows)
+    log.info(f"Moved the full text of {moved} acts", extra={"tag": "DB"})
+
+
+def clear_table(table: str):
+    def step(conn):
+        conn.execute(text(f'DELETE FROM "{table}"'))
+
+    return step
+
+
+def drop_index(name: str):
+    def step(conn):
+        conn.execute(text(f'DROP INDEX IF EXISTS "{name}"'))
+
+    return step
+
+
+def queue_unsent_messages(conn):
+    """
+    Finish times of the messages queued before they were assigned on insert, with the per-query
+    ordering Postman used before: the n-th message of a flow finishes at n / weight.
+    """
+    Message = models.Message
+    flow = Message.get_flow_expression()
+    unsent = and_(Message.sent == false(), Message.error.is_(None))
+    rank = func.row_number().over(partition_by=flow, order_by=Message.timestamp.asc())
+    cost = case({int(k): 1.0 / v for k, v in models.PRIORITY_WEIGHTS.items()}, value=Message.priority, else_=1.0)
+    queue = select(Message.id, (cast(rank, Float) * cost).label("finish")).where(
+        and_(unsent, Message.finish.is_(None))
+    ).subquery()
+    conn.execute(update(Message).where(Message.id == queue.c.id).values(finish=queue.c.finish))
+    last = select(flow, func.max(Message.finish)).where(unsent).group_by(flow)
+    conn.execute(pg_insert(models.MessageFlow).from_select(["flow", "last_finish"], last).on_conflict_do_nothing())
+
+
+def notify_user_updates(conn):
+    """Trigger notifying the bots when the flags of a user change or the user is deleted, the cache drops it"""
+    conn.execute(
+        text(
+            "CREATE OR REPLACE FUNCTION notify_user_updated() RETURNS trigger AS $$ "
+            "BEGIN "
+            f"PERFORM pg_notify('{events.USER_UPDATED}', OLD.id::text); "
+            "RETURN NULL; "
+            "END; $$ LANGUAGE plpgsql"
+        )
+    )
+    conn.execute(text("DROP TRIGGER IF EXISTS user_updated ON users"))
+    conn.execute(
+        text(
+            "CREATE TRIGGER user_updated AFTER UPDATE OF is_banned, is_premium, is_admin ON users FOR EACH ROW "
+            "WHEN ((OLD.is_banned, OLD.is_premium, OLD.is_admin) IS DISTINCT FROM "
+            "(NEW.is_banned, NEW.is_premium, NEW.is_admin)) EXECUTE FUNCTION notify_user_updated()"
+        )
+    )
+    conn.execute(text("DROP TRIGGER IF EXISTS user_deleted ON users"))
+    conn.execute(
+        text("CREATE TRIGGER user_deleted AFTER DELETE ON users FOR EACH ROW EXECUTE FUNCTION notify_user_updated()")
+    )
+
+
+def get_index(name: str):
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name == name:
+                return index
+    raise KeyError(f"No index named {name}")
+
+
+MIGRATIONS = [
+    Migration(
+        1, "Rendered payload on queued messages", [
+            add_column("messages", "parse_mode"),
+            add_column("messages", "reply_markup"),
+        ]
+    ),
+    # priority and its index predate the migrations, the index is dropped by migration 11
+    Migration(2, "Message priorities, already in the schema", []),
+    # the search vector moved to acts_text with migration 5
+    Migration(3, "Full-text search on acts, moved by migration 5", []),
+    Migration(
+        4, "Queue and fan-out indexes", [
+            add_index("ix_acts_queue"),
+            # ix_messages_queue is created by migration 7, on the finish time
+            add_index("ix_trackings_court_user"),
+        ]
+    ),
+    Migration(
+        5, "Compressed full text out of acts", [
+            add_table("acts_text"),
+            move_full_text,
+            drop_column("acts", "search_vector"),
+            drop_column("acts", "full_text"),
+        ]
+    ),
+    Migration(6, "Near-duplicate acts", [
+        add_table("act_fingerprints"),
+        add_column("acts-info", "duplicate_of"),
+    ]),
+    Migration(
+        7, "Finish times of the message queue", [
+            add_column("messages", "finish"),
+            add_table("message_flows"),
+            queue_unsent_messages,
+            drop_index("ix_messages_queue"),
+            add_index("ix_messages_queue"),
+        ]
+    ),
+    Migration(8, "Notify the bots of user changes", [notify_user_updates]),
+    Migration(9, "Keyset order of the act queue", [
+        drop_index("ix_acts_queue"),
+        add_index("ix_acts_queue"),
+    ]),
+    # the buckets of 8 bands never match the new ones, Sherlock indexes the recent acts again
+    Migration(10, "LSH index of 16 bands", [clear_table("act_fingerprints")]),
+    # the queue is ordered by finish time, nothing reads messages by priority
+    Migration(11, "No index on the message priority", [drop_index("ix_messages_priority")]),
+    # searches filter on acts.date, the copy in acts_text was never read
+    Migration(12, "No date in acts_text", [
+        drop_index("ix_acts_text_date"),
+        drop_column("acts_text", "date"),
+    ]),
+    # the acts indexed without a signature are indexed again by Sherlock
+    Migration(13, "MinHash signatures of the acts", [
+        add_column("acts_text", "signature"),
+        clear_table("act_fingerprints"),
+    ]),
+]
+
+
+def get_version(conn) -> int:
+    return conn.execute(select(func.max(models.SchemaVersion.version))).scalar() or 0
+
+
+def upgrade(engine):
+    """Applies the missing migrations, each one in its own transaction"""
+    models.SchemaVersion.__table__.create(engine, checkfirst=True)
+    for migration in MIGRATIONS:
+        with engine.begin() as conn:
+            conn.execute(select(func.pg_advisory_xact_lock(LOCK_ID)))
+            if migration.version <= get_version(conn):
+                continue
+            log.info(f"Applying migration {migration.version}: {migration.description}", extra={"tag": "DB"})
+            for step in migration.steps:
+                step(conn)
+            conn.execute(
+                insert(models.SchemaVersion).values(version=migration.version, description=migration.description)
+            )
+    with engine.connect() as conn:
+        log.info(f"Database schema at version {get_version(conn)}", extra={"tag": "DB"})
+
+
+# plan nodes that mean the rows were not read in the order of the index
+SORT_NODES = {"Sort", "Incremental Sort", "WindowAgg"}
+
+
+def hot_queries():
+    """Index each hot query is expected to use, with the statement as run by the services"""
+    return {
+        "ix_acts_queue": models.Act.get_queue_stmt(limit=50),
+        "ix_messages_queue": models.Message.get_queue_stmt(limit=50),
+        "ix_trackings_court_user": models.Tracking.get_recipients_stmt(court_id="000000", only_tlc=True),
+    }
+
+
+def get_plan_values(plan, key: str) -> set:
+    """Values of a key in every node of an EXPLAIN (FORMAT JSON) plan"""
+    values = set()
+    if isinstance(plan, dict):
+        if key in plan:
+            values.add(plan[key])
+        for v in plan.values():
+            values |= get_plan_values(v, key)
+    elif isinstance(plan, list):
+        for v in plan:
+            values |= get_plan_values(v, key)
+    return values
+
+
+def check_indexes(engine) -> dict:
+    """
+    Runs EXPLAIN on every hot query and returns, for each expected index, whether the plan reads the rows
+    from it already in order: the index is used and there is no sort over its rows.
+    Sequential scans are disabled so that a small database (where a scan is cheaper) shows whether
+    the index can serve the query at all.
+    """
+    results = {}
+    with engine.connect() as conn:
+        for index, stmt in hot_queries().items():
+            with conn.begin():
+                conn.execute(text("SET LOCAL enable_seqscan = off"))
+                sql = stmt.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True})
+                plan = conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {sql}").scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            used = get_plan_values(plan, "Index Name")
+            sorts = get_plan_values(plan, "Node Type") & SORT_NODES
+            results[index] = index in used and not sorts
+            status = "used in order" if results[index] else "NOT used in order"
+            log.info(
+                f"{index}: {status} - plan indexes {sorted(used)}, sorts {sorted(sorts)}", extra={"tag": "DB"}
+            )
+    return results
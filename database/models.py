@@ -6,26 +6,42 @@ from sqlalchemy import (  # type: ignore
     Column,
     Date,
     Enum,
+    Float,
     ForeignKey,
+    Index,
     Integer,
     String,
     Time,
     and_,
+    event,
     exists,
     func,
+    inspect,
+    literal,
     select,
 )
-from sqlalchemy.dialects.postgresql import JSONB, MONEY, SMALLINT, TEXT, TIMESTAMP
+from sqlalchemy.dialects.postgresql import BYTEA, JSONB, MONEY, SMALLINT, TEXT, TIMESTAMP, TSVECTOR
 from sqlalchemy.dialects.postgresql.ranges import TSTZRANGE  # type: ignore
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.ext.mutable import MutableDict
-from sqlalchemy.orm import backref, column_property, declarative_base, relationship
+from sqlalchemy.orm import Session, backref, column_property, declarative_base, deferred, relationship
 from sqlalchemy.orm.exc import DetachedInstanceError
-from sqlalchemy.sql.expression import true
+from sqlalchemy.sql.expression import false, true
 from sqlalchemy.sql.sqltypes import BigInteger
 
-from database.utils import ActHelper, DocHelper, MessageHelper, TrackingHelper, UserHelper, UserReportHelper
+from database.types import CompressedText
+from database.utils import (
+    ActFingerprintHelper,
+    ActHelper,
+    CourtHelper,
+    CourtStatsHelper,
+    DocHelper,
+    MessageHelper,
+    TrackingHelper,
+    UserHelper,
+    UserReportHelper,
+)
 
 Base = declarative_base()
 
@@ -100,6 +116,9 @@ class Tracking(ReprBase, TrackingHelper, Base):
     track_all = Column(Boolean, default=False)
     timestamp = Column(TIMESTAMP(timezone=True), nullable=False, server_default=func.now())
 
+    # the primary key starts with user_id, notifications look up the users of a court
+    __table_args__ = (Index("ix_trackings_court_user", court_id, user_id), )
+
     def __repr__(self):
         return self._repr(
             user_id=self.user_id,
@@ -111,7 +130,7 @@ class Tracking(ReprBase, TrackingHelper, Base):
         )
 
 
-class Act(MixinSearch, ReprBase, ActHelper, Base):
+class Act(ReprBase, ActHelper, Base):
     __tablename__ = "acts"
 
     id = Column(Integer, primary_key=True)
@@ -131,7 +150,9 @@ class Act(MixinSearch, ReprBase, ActHelper, Base):
     # one to many - Act -> Reports
     reports = relationship("UserReport", back_populates="act")
     text = Column(TEXT, nullable=False)
-    full_text = Column(TEXT, nullable=False)
+    # one to one - Act -> ActText, the judgment is kept out of the hot table and loaded on demand
+    body = relationship("ActText", back_populates="act", uselist=False, cascade="all, delete-orphan")
+    full_text = association_proxy("body", "full_text", creator=lambda full_text: ActText(full_text=full_text))
     is_tlc = Column(Boolean, default=False)
     date = Column(Date, index=True, nullable=False)
     notify = Column(Boolean, default=False)
@@ -140,6 +161,11 @@ class Act(MixinSearch, ReprBase, ActHelper, Base):
     error = Column(String, index=True)
     timestamp = Column(TIMESTAMP(timezone=True), index=True, nullable=False, server_default=func.now())
 
+    __table_args__ = (
+        # Sherlock queue, only the acts still to process
+        Index("ix_acts_queue", timestamp, id, postgresql_where=and_(processed_at.is_(None), error.is_(None))),
+    )
+
     def __repr__(self):
         return self._repr(
             id=self.id,
@@ -153,7 +179,65 @@ class Act(MixinSearch, ReprBase, ActHelper, Base):
         )
 
 
-class Court(ReprBase, Base):
+class ActText(ReprBase, Base):
+    """Full text of an act, compressed, with the search vector of the act"""
+    __tablename__ = "acts_text"
+
+    act_id = Column(Integer, ForeignKey("acts.id", ondelete="CASCADE"), primary_key=True)
+    act = relationship("Act", back_populates="body")
+    full_text = Column(CompressedText, nullable=False)
+    # postgres can't read the compressed text, the vector is computed on write (set_search_vector)
+    search_vector = deferred(Column(TSVECTOR))
+    # MinHash signature of full_text, written with the LSH buckets (ActFingerprint.add)
+    signature = deferred(Column(BYTEA))
+
+    __table_args__ = (
+        Index("ix_acts_text_search_vector", search_vector, postgresql_using="gin"),
+    )
+
+    def __repr__(self):
+        return self._repr(act_id=self.act_id)
+
+
+def get_search_vector(text: str, full_text: str):
+    return func.setweight(func.to_tsvector("italian", literal(text, TEXT)), "A").op("||")(
+        func.setweight(func.to_tsvector("italian", literal(full_text, TEXT)), "B")
+    )
+
+
+@event.listens_for(ActText, "before_insert")
+@event.listens_for(ActText, "before_update")
+def set_search_vector(mapper, connection, target):
+    target.search_vector = get_search_vector(target.act.text, target.full_text)
+
+
+@event.listens_for(Session, "before_flush")
+def refresh_search_vectors(session, flush_context, instances):
+    """The vector also covers the act text, which Sherlock rewrites after the body is stored"""
+    for act in session.dirty:
+        if not isinstance(act, Act):
+            continue
+        attrs = inspect(act).attrs
+        if attrs.text.history.has_changes() and act.body is not None:
+            # marks the body dirty, set_search_vector computes the vector on its update
+            act.body.search_vector = None
+
+
+class ActFingerprint(ReprBase, ActFingerprintHelper, Base):
+    """LSH buckets of the MinHash signature of an act, one row per band, kept for the recent acts only"""
+    __tablename__ = "act_fingerprints"
+
+    band = Column(SMALLINT, primary_key=True)
+    bucket = Column(BigInteger, primary_key=True)
+    act_id = Column(Integer, ForeignKey("acts.id", ondelete="CASCADE"), primary_key=True)
+    court_id = Column(String(6), nullable=False)
+    date = Column(Date, nullable=False, index=True)
+
+    def __repr__(self):
+        return self._repr(band=self.band, bucket=self.bucket, act_id=self.act_id)
+
+
+class Court(ReprBase, CourtHelper, Base):
     __tablename__ = "courts"
 
     # istat code
@@ -181,6 +265,25 @@ class Court(ReprBase, Base):
         )
 
 
+class CourtStats(ReprBase, CourtStatsHelper, Base):
+    """Counters shown by the bot, kept up to date by the scraper, Sherlock and the tracking helpers"""
+    __tablename__ = "court_stats"
+
+    court_id = Column(String(6), ForeignKey('courts.id'), primary_key=True)
+    user_count = Column(Integer, nullable=False, default=0)
+    act_count = Column(Integer, nullable=False, default=0)
+    act_count_tlc = Column(Integer, nullable=False, default=0)
+    updated_at = Column(TIMESTAMP(timezone=True), server_default=func.now(), onupdate=func.current_timestamp())
+
+    def __repr__(self):
+        return self._repr(
+            court_id=self.court_id,
+            user_count=self.user_count,
+            act_count=self.act_count,
+            act_count_tlc=self.act_count_tlc,
+        )
+
+
 class DocType(enum.Enum):
     text = 1
     web = 2
@@ -225,7 +328,9 @@ class ActInfo(ReprBase, Base):
     ai_info = Column(MutableDict.as_mutable(JSONB), default=dict)
     # one to many - ActInfo > Doc
     docs = relationship("Doc", back_populates="info", cascade="all, delete-orphan")
-    has_docs = column_property(exists().where(Doc.info_id == id))
+    has_docs = column_property(exists().where(Doc.info_id == id), deferred=True)
+    # likely the same act published again (Sherlock, MinHash), no foreign key as acts already points here
+    duplicate_of = Column(Integer)
     timestamp = Column(TIMESTAMP(timezone=True), nullable=False, server_default=func.now())
 
     def __repr__(self):
@@ -367,6 +472,22 @@ class User(ReprBase, UserHelper, Base):
         )
 
 
+class MessagePriorities(enum.IntEnum):
+    regular = 0
+    premium = 1
+    channel = 2
+    admin = 1000
+
+
+# share of the sending rate of each priority class
+PRIORITY_WEIGHTS = {
+    MessagePriorities.regular: 1,
+    MessagePriorities.premium: 2,
+    MessagePriorities.channel: 4,
+    MessagePriorities.admin: 1000,
+}
+
+
 class Message(ReprBase, MessageHelper, Base):
     __tablename__ = "messages"
 
@@ -378,6 +499,9 @@ class Message(ReprBase, MessageHelper, Base):
     act_id = Column(Integer, ForeignKey('acts.id'), nullable=True)
     act = relationship("Act", back_populates="messages", cascade="save-update")
     text = Column(String, nullable=False)
+    parse_mode = Column(String(10), default="html", server_default="html", nullable=False)
+    # serialized InlineKeyboardMarkup, rendered when the message is queued
+    reply_markup = Column(TEXT)
     url_preview = Column(Boolean, default=True, nullable=False)
     short_url = Column(String)
     sent = Column(Boolean, default=False, index=True)
@@ -387,9 +511,14 @@ class Message(ReprBase, MessageHelper, Base):
     sent_at = Column(TIMESTAMP(timezone=True))
     message_id = Column(Integer)
     chat_id = Column(BigInteger)
-    priority = Column(Integer, index=True, default=0)
+    priority = Column(Integer, default=MessagePriorities.regular, server_default="0")
+    # virtual finish time in the weighted fair queue, assigned on insert (MessageHelper.assign_finish)
+    finish = Column(Float)
     timestamp = Column(TIMESTAMP(timezone=True), nullable=False, server_default=func.now())
 
+    # Postman queue, only the messages still to send
+    __table_args__ = (Index("ix_messages_queue", finish, postgresql_where=and_(sent == false(), error.is_(None))), )
+
     def __repr__(self):
         return self._repr(
             id=self.id,
@@ -408,6 +537,61 @@ class Message(ReprBase, MessageHelper, Base):
         )
 
 
+@event.listens_for(Session, "before_flush")
+def queue_messages(session, flush_context, instances):
+    if messages := [o for o in session.new if isinstance(o, Message) and o.finish is None]:
+        Message.assign_finish(session, messages)
+
+
+class MessageFlow(ReprBase, Base):
+    """Finish time of the last message queued in each flow of the weighted fair queue"""
+    __tablename__ = "message_flows"
+
+    flow = Column(String, primary_key=True)
+    last_finish = Column(Float, nullable=False, index=True)
+
+    def __repr__(self):
+        return self._repr(flow=self.flow, last_finish=self.last_finish)
+
+
+class MessageArchive(ReprBase, Base):
+    """Sent and deleted messages moved out of the queue by MessageHelper.archive, same ids as messages"""
+    __tablename__ = "messages_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(BigInteger, index=True)
+    act_id = Column(Integer, index=True)
+    text = Column(String, nullable=False)
+    parse_mode = Column(String(10))
+    reply_markup = Column(TEXT)
+    url_preview = Column(Boolean)
+    short_url = Column(String)
+    sent = Column(Boolean)
+    deleted = Column(Boolean)
+    error = Column(String)
+    username = Column(String)
+    sent_at = Column(TIMESTAMP(timezone=True), index=True)
+    message_id = Column(Integer)
+    chat_id = Column(BigInteger)
+    priority = Column(Integer)
+    timestamp = Column(TIMESTAMP(timezone=True), nullable=False)
+    archived_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=func.now())
+
+    __table_args__ = (Index("ix_messages_archive_tg_ids", chat_id, message_id), )
+
+
+class SchemaVersion(ReprBase, Base):
+    """Migrations applied to the database, see database.migrations"""
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String, nullable=False)
+    applied_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=func.now())
+
+    def __repr__(self):
+        return self._repr(version=self.version, description=self.description, applied_at=self.applied_at)
+
+
 Court.has_users = column_property(
     exists().where(Tracking.court_id == Court.id).correlate_except(Tracking), deferred=True
 )
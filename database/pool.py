@@ -0,0 +1,154 @@
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+
+from database.config import DatabaseConfig
+
+config = DatabaseConfig.from_environ()
+
+
+class PoolMetrics():
+    """Counters of a connection pool, filled by InstrumentedPool and the connect/close events"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.overflow_peak = 0
+        self.opened = 0
+        self.closed = 0
+        self.lifetime_total = 0.0
+        self.lifetime_max = 0.0
+
+    def checkout(self, wait: float, overflow: int):
+        with self.lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.overflow_peak = max(self.overflow_peak, overflow)
+
+    def timeout(self, wait: float):
+        with self.lock:
+            self.timeouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def connect(self, record):
+        record.info["opened_at"] = time.monotonic()
+        with self.lock:
+            self.opened += 1
+
+    def close(self, record):
+        if (opened_at := record.info.pop("opened_at", None)) is None:
+            return
+        lifetime = time.monotonic() - opened_at
+        with self.lock:
+            self.closed += 1
+            self.lifetime_total += lifetime
+            self.lifetime_max = max(self.lifetime_max, lifetime)
+
+
+class InstrumentedPool():
+    """Times how long each checkout waits for a free (or new) connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+        if kwargs.get("_dispatch") is None:
+            # a recreated pool gets the listeners (and the metrics, in recreate) of the old one
+            metrics = self.metrics
+            event.listen(self, "connect", lambda dbapi_conn, record: metrics.connect(record))
+            event.listen(self, "close", lambda dbapi_conn, record: metrics.close(record))
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            entry = super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.timeout(time.monotonic() - start)
+            raise
+        self.metrics.checkout(time.monotonic() - start, self.get_overflow())
+        return entry
+
+    def get_overflow(self) -> int:
+        return 0
+
+    def stats(self) -> dict:
+        m = self.metrics
+        with m.lock:
+            return {
+                "size": self.size() if isinstance(self, QueuePool) else 0,
+                "checked_out": self.checkedout() if isinstance(self, QueuePool) else None,
+                "overflow": self.get_overflow(),
+                "overflow_peak": m.overflow_peak,
+                "checkouts": m.checkouts,
+                "timeouts": m.timeouts,
+                "wait_avg_ms": round(m.wait_total / m.checkouts * 1000, 2) if m.checkouts else 0,
+                "wait_max_ms": round(m.wait_max * 1000, 2),
+                "opened": m.opened,
+                "closed": m.closed,
+                "lifetime_avg_s": round(m.lifetime_total / m.closed, 1) if m.closed else 0,
+                "lifetime_max_s": round(m.lifetime_max, 1),
+            }
+
+
+class InstrumentedQueuePool(InstrumentedPool, QueuePool):
+    def get_overflow(self) -> int:
+        return max(0, self.checkedout() - self.size())
+
+
+class InstrumentedNullPool(InstrumentedPool, NullPool):
+    pass
+
+
+class InstrumentedAsyncQueuePool(InstrumentedQueuePool, AsyncAdaptedQueuePool):
+    pass
+
+
+def engine_options(asyncio: bool = False) -> dict:
+    """
+    create_engine arguments for the pool configured in TBOT_PSQL_POOL_*. Every service reads its own
+    environment, so the pool is sized per container. With PgBouncer (transaction pooling) the connections
+    are pooled by PgBouncer: no pool here, no startup options (PgBouncer rejects them, the statement timeout
+    is set by set_statement_timeout) and, for asyncpg, no prepared statements.
+    """
+    pool = config.pool
+    if pool.pgbouncer:
+        options = {"poolclass": InstrumentedNullPool}
+        if asyncio:
+            options["connect_args"] = {"statement_cache_size": 0, "prepared_statement_cache_size": 0}
+        return options
+    options = {
+        "poolclass": InstrumentedAsyncQueuePool if asyncio else InstrumentedQueuePool,
+        "pool_size": pool.size,
+        "max_overflow": pool.overflow,
+        "pool_timeout": pool.timeout,
+        "pool_recycle": pool.recycle,
+        "pool_pre_ping": pool.pre_ping,
+    }
+    if pool.statement_timeout and asyncio:
+        options["connect_args"] = {"server_settings": {"statement_timeout": str(pool.statement_timeout)}}
+    elif pool.statement_timeout:
+        options["connect_args"] = {"options": f"-c statement_timeout={pool.statement_timeout}"}
+    return options
+
+
+def set_statement_timeout(engine):
+    """In PgBouncer mode the timeout is set at the start of every transaction, SET LOCAL ends with it"""
+    if not (config.pool.pgbouncer and config.pool.statement_timeout):
+        return
+
+    @event.listens_for(engine, "begin")
+    def begin(conn):
+        cursor = conn.connection.dbapi_connection.cursor()
+        cursor.execute(f"SET LOCAL statement_timeout = {config.pool.statement_timeout}")
+        cursor.close()
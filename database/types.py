@@ -0,0 +1,25 @@
+import zlib
+
+from sqlalchemy.dialects.postgresql import BYTEA
+from sqlalchemy.types import TypeDecorator
+
+
+class CompressedText(TypeDecorator):
+    """Text stored compressed with zlib, judgments are long and compress several times over"""
+
+    impl = BYTEA
+    cache_ok = True
+
+    def __init__(self, level: int = 6):
+        super().__init__()
+        self.level = level
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return zlib.compress(value.encode("utf-8"), self.level)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return zlib.decompress(value).decode("utf-8")
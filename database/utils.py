@@ -1,14 +1,20 @@
+import datetime as dt
 import html
+import json
 
-import requests
 from hashids import Hashids
-from sqlalchemy import and_, func, update
+from sqlalchemy import and_, case, func, insert, or_, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.future import select
 from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.sql.expression import delete, false, true
 from sqlalchemy.sql.sqltypes import Boolean
 
+import database.events as events
+import database.loaders as loaders
 import database.models as models
+import store.store as store
 from database.config import ActConfig
 from logger.logger import log
 
@@ -42,6 +48,22 @@ class UserHelper():
         else:
             return user
 
+    @classmethod
+    async def aget_or_create(cls, session, **kwargs):
+        user = await session.get(cls, kwargs.get("id"))
+        if user:
+            return user
+        user = cls(**kwargs)
+        try:
+            session.add(user)
+            await session.commit()
+        except Exception:
+            log.exception(f"Error while saving {user}", extra={"tag": "DB"})
+            await session.rollback()
+            return None
+        else:
+            return user
+
     @classmethod
     def get_admin_ids(cls, session):
         stmt = select(cls.id).where(cls.is_admin == true())
@@ -50,45 +72,83 @@ class UserHelper():
 
 class TrackingHelper():
     @classmethod
-    def get_users_id(cls, session, court_id: str, only_tlc=False):
+    def get_recipients_stmt(cls, court_id: str, only_tlc=False):
+        stmt = select(cls.user_id, models.User.is_premium).join(models.User)
         if only_tlc:
-            stmt = select(cls.user_id).join(models.User).where(
-                and_(cls.court_id == court_id, models.User.is_banned == false())
-            )
-        else:
-            stmt = select(cls.user_id).join(models.User).where(
-                and_(cls.court_id == court_id, cls.track_all == true(), models.User.is_banned == false())
-            )
-        return session.execute(stmt).scalars().all()
+            return stmt.where(and_(cls.court_id == court_id, models.User.is_banned == false()))
+        return stmt.where(and_(cls.court_id == court_id, cls.track_all == true(), models.User.is_banned == false()))
+
+    @classmethod
+    def get_recipients(cls, session, court_id: str, only_tlc=False):
+        """Ids of the users to notify, with the premium flag used to pick the message priority"""
+        return session.execute(cls.get_recipients_stmt(court_id, only_tlc=only_tlc)).all()
+
+    @classmethod
+    def get_stmt(cls, user_id: int, court_id: str):
+        return select(cls).where(and_(cls.user_id == user_id, cls.court_id == court_id))
 
     @classmethod
     def get(cls, session, user_id: int, court_id: str):
-        stmt = select(cls).where(and_(cls.user_id == user_id, cls.court_id == court_id))
-        return session.execute(stmt).scalar()
+        return session.execute(cls.get_stmt(user_id, court_id)).scalar()
+
+    @classmethod
+    async def aget(cls, session, user_id: int, court_id: str):
+        return (await session.execute(cls.get_stmt(user_id, court_id))).scalar()
+
+    @classmethod
+    def get_by_user_stmt(cls, user_id: int):
+        return select(models.Court).join(cls).where(cls.user_id == user_id)
 
     @classmethod
     def get_by_user(cls, session, user_id: int):
-        stmt = select(models.Court).join(cls).where(cls.user_id == user_id)
-        return session.execute(stmt).scalars().all()
+        return session.execute(cls.get_by_user_stmt(user_id)).scalars().all()
+
+    @classmethod
+    async def aget_by_user(cls, session, user_id: int):
+        return (await session.execute(cls.get_by_user_stmt(user_id))).scalars().all()
+
+    @classmethod
+    def update_stmt(cls, user_id: int, court_id: str, dct):
+        return update(cls).where(and_(cls.user_id == user_id, cls.court_id == court_id)).values(dct)
 
     @classmethod
     def update(cls, session, user_id: int, court_id: str, new_state):
         dct = {"track_all": new_state}
-        stmt = update(cls).where(and_(cls.user_id == user_id, cls.court_id == court_id)).values(dct)
-        session.execute(stmt)
+        session.execute(cls.update_stmt(user_id, court_id, dct))
         session.commit()
         log.info(f"Updated tracking {user_id} -> {dct}", extra={"tag": "DB"})
 
+    @classmethod
+    async def aupdate(cls, session, user_id: int, court_id: str, new_state):
+        dct = {"track_all": new_state}
+        await session.execute(cls.update_stmt(user_id, court_id, dct))
+        await session.commit()
+        log.info(f"Updated tracking {user_id} -> {dct}", extra={"tag": "DB"})
+
+    @classmethod
+    def delete_stmt(cls, user_id: int, court_id: str):
+        return delete(cls).where(and_(cls.user_id == user_id, cls.court_id == court_id))
+
     @classmethod
     def delete(cls, session, user_id: int, court_id: str):
         if not cls.get(session, user_id=user_id, court_id=court_id):
             return False
-        stmt = delete(cls).where(and_(cls.user_id == user_id, cls.court_id == court_id))
-        session.execute(stmt)
+        session.execute(cls.delete_stmt(user_id, court_id))
+        models.CourtStats.increment(session, court_id, user_count=-1)
         log.info(f"Deleted tracking: {user_id} - {court_id}", extra={"tag": "DB"})
         session.commit()
         return True
 
+    @classmethod
+    async def adelete(cls, session, user_id: int, court_id: str):
+        if not await cls.aget(session, user_id=user_id, court_id=court_id):
+            return False
+        await session.execute(cls.delete_stmt(user_id, court_id))
+        await session.execute(models.CourtStats.increment_stmt(court_id, user_count=-1))
+        log.info(f"Deleted tracking: {user_id} - {court_id}", extra={"tag": "DB"})
+        await session.commit()
+        return True
+
     @classmethod
     def create(cls, session, user_id: int, court_id: str):
         stmt = select(cls).where(and_(cls.user_id == user_id, cls.court_id == court_id))
@@ -98,24 +158,92 @@ class TrackingHelper():
             return court, True
         tracking = cls(user_id=user_id, court_id=court_id)
         session.add(tracking)
+        models.CourtStats.increment(session, court_id, user_count=1)
         session.commit()
         log.info(f"New tracking added: {user_id} - {tracking.court}", extra={"tag": "DB"})
         return tracking.court, False
 
     @classmethod
-    def paginate(cls, session, page: int, page_size: int):
-        stmt = select(models.Court).limit(page_size).offset(page * page_size).order_by(models.Court.name)
-        courts = session.execute(stmt).scalars().all()
-        stmt = select(func.count(models.Court.id))
-        count = session.execute(stmt).scalar()
-        return courts, count
+    async def acreate(cls, session, user_id: int, court_id: str):
+        # no lazy loading with asyncio, the court is always loaded explicitly
+        court = await session.get(models.Court, court_id)
+        if await cls.aget(session, user_id=user_id, court_id=court_id):
+            log.info(f"Duplicate tracking: {user_id} - {court}", extra={"tag": "DB"})
+            return court, True
+        session.add(cls(user_id=user_id, court_id=court_id))
+        await session.execute(models.CourtStats.increment_stmt(court_id, user_count=1))
+        await session.commit()
+        log.info(f"New tracking added: {user_id} - {court}", extra={"tag": "DB"})
+        return court, False
+
+    @classmethod
+    def get_states_stmt(cls, user_id: int, court_ids):
+        return select(cls.court_id, cls.track_all).where(and_(cls.user_id == user_id, cls.court_id.in_(court_ids)))
+
+    @classmethod
+    def get_states(cls, session, user_id: int, court_ids):
+        """Maps the given courts tracked by the user to their track_all flag"""
+        return dict(session.execute(cls.get_states_stmt(user_id, court_ids)).all())
+
+    @classmethod
+    async def aget_states(cls, session, user_id: int, court_ids):
+        return dict((await session.execute(cls.get_states_stmt(user_id, court_ids))).all())
+
+
+class CourtHelper():
+    @classmethod
+    def get_all(cls, session):
+        stmt = select(cls).order_by(cls.name)
+        return session.execute(stmt).scalars().all()
+
+
+class CourtStatsHelper():
+    @classmethod
+    def get(cls, session, court_id: str):
+        return session.get(cls, court_id)
+
+    @classmethod
+    def increment_stmt(cls, court_id: str, **deltas):
+        stmt = pg_insert(cls).values(court_id=court_id, **{k: max(v, 0) for k, v in deltas.items()})
+        return stmt.on_conflict_do_update(
+            index_elements=[cls.court_id],
+            set_={
+                **{k: cls.__table__.c[k] + v for k, v in deltas.items()}, "updated_at": func.now()
+            },
+        )
+
+    @classmethod
+    def increment(cls, session, court_id: str, **deltas):
+        """Adds the deltas to the counters of a court, the change is committed by the caller"""
+        session.execute(cls.increment_stmt(court_id, **deltas))
+
+    @classmethod
+    def refresh(cls, session):
+        """Recomputes the counters of every court from acts and trackings"""
+        court = models.Court
+        stmt = pg_insert(cls).from_select(
+            ["court_id", "user_count", "act_count", "act_count_tlc"],
+            select(court.id, court.user_count, court.act_count, court.act_count_tlc),
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[cls.court_id],
+            set_={
+                "user_count": stmt.excluded.user_count,
+                "act_count": stmt.excluded.act_count,
+                "act_count_tlc": stmt.excluded.act_count_tlc,
+                "updated_at": func.now(),
+            },
+        )
+        session.execute(stmt)
+        session.commit()
+        log.info("Refreshed court stats", extra={"tag": "DB"})
 
 
 class ActHelper():
 
     config = ActConfig.from_environ()
     hash_ = Hashids(salt=config.hash_secret, min_length=16) if config.hash_secret else None
-    templates = requests.get(config.url.templates, timeout=60).json() if config.url.templates else []
+    templates = store.templates
 
     @classmethod
     def get_info_id(cls, session, uuid: str):
@@ -127,14 +255,84 @@ class ActHelper():
         stmt = select(cls).where(cls.uuid_hr == uuid_hr)
         return session.execute(stmt).scalar()
 
+    @classmethod
+    def get_queue_stmt(cls, limit: int, after=None):
+        """Acts waiting for Sherlock, oldest first, after the (timestamp, id) of the last act seen"""
+        # UPDATE permits SET processed_at = TO_TIMESTAMP('2021-01-01', 'YYYY-MM-DD')
+        stmt = select(cls).where(and_(cls.processed_at.is_(None), cls.error.is_(None)))
+        if after:
+            stmt = stmt.where(tuple_(cls.timestamp, cls.id) > tuple_(*after))
+        return stmt.order_by(cls.timestamp.asc(), cls.id.asc()).limit(limit)
+
+    @classmethod
+    def get_by_uuid_stmt(cls, uuid: str):
+        return select(cls).where(cls.uuid == uuid).options(*loaders.options("bot_card"))
+
     @classmethod
     def get_by_uuid(cls, session, uuid: str):
-        stmt = select(cls).where(cls.uuid == uuid).options(joinedload(cls.court))
-        return session.execute(stmt).scalar()
+        return session.execute(cls.get_by_uuid_stmt(uuid)).scalar()
+
+    @classmethod
+    async def aget_by_uuid(cls, session, uuid: str):
+        return (await session.execute(cls.get_by_uuid_stmt(uuid))).scalar()
+
+    @classmethod
+    def search(
+        cls,
+        session,
+        query: str = None,
+        court_id: str = None,
+        since: dt.date = None,
+        until: dt.date = None,
+        page: int = 0,
+        page_size: int = 5,
+        ranked: bool = True,
+        load_info: bool = False
+    ):
+        """
+        Full-text search, returns the acts in the page and the number of matches.
+        Acts are ranked by relevance, or just sorted from the newest with ranked=False.
+        """
+        stmt = select(cls, func.count().over().label("total")).where(cls.error.is_(None))
+        order = [cls.date.desc()]
+        if query:
+            tsquery = func.websearch_to_tsquery("italian", query)
+            vector = models.ActText.search_vector
+            stmt = stmt.join(models.ActText, models.ActText.act_id == cls.id).where(vector.op("@@")(tsquery))
+            if ranked:
+                order.insert(0, func.ts_rank(vector, tsquery).desc())
+        if court_id:
+            stmt = stmt.where(cls.court_id == court_id)
+        if since:
+            stmt = stmt.where(cls.date >= since)
+        if until:
+            stmt = stmt.where(cls.date <= until)
+        stmt = stmt.options(*loaders.options("bot_card")) if load_info else stmt.options(joinedload(cls.court))
+        stmt = stmt.order_by(*order).offset(page * page_size).limit(page_size)
+        rows = session.execute(stmt).all()
+        return [r.Act for r in rows], rows[0].total if rows else 0
 
     def set_properties(self):
         self.uuid = ActHelper.hash_.encode(self.id)
 
+    def publish_update(self, session):
+        """Tells the bot processes to drop what they cached about this act once the session commits"""
+        events.publish(session, events.ACT_UPDATED, self.uuid)
+
+    def get_deeplink(self, prefix: str = ""):
+        return ActHelper.config.url.deeplink.format(f"{prefix}{self.uuid}")
+
+    def get_message_markup(self, private: bool) -> str:
+        """Serialized inline keyboard attached to the notifications of this act"""
+        buttons = ActHelper.templates["italian"]["keyboard"]["inline_buttons"]
+        if private:
+            btn_layout = [{"text": buttons["details"], "callback_data": f"a.info:{self.uuid}"}]
+        else:
+            btn_layout = [{"text": buttons["details"], "url": self.get_deeplink()}]
+            if self.info.has_docs:
+                btn_layout.append({"text": buttons["docs"], "url": self.get_deeplink("docs-")})
+        return json.dumps({"inline_keyboard": [btn_layout]})
+
     def get_telegram_text(self):
         text = ActHelper.templates["italian"]["messages"]["template"].format(
             tribunale=self.court.name.upper(),
@@ -150,6 +348,54 @@ class ActHelper():
         return text
 
 
+class ActFingerprintHelper:
+    @classmethod
+    def get_candidates(cls, session, buckets, court_id: str, exclude_id: int = None, limit: int = None):
+        """
+        Acts of the court sharing at least one band bucket, the ones sharing more bands first,
+        with their stored signature
+        """
+        ActText = models.ActText
+        matches = func.count().label("matches")
+        stmt = select(cls.act_id, matches, ActText.signature).join(ActText, ActText.act_id == cls.act_id).where(
+            and_(tuple_(cls.band, cls.bucket).in_(list(enumerate(buckets))), cls.court_id == court_id)
+        )
+        if exclude_id:
+            stmt = stmt.where(cls.act_id != exclude_id)
+        stmt = stmt.group_by(cls.act_id, ActText.act_id).order_by(matches.desc(), cls.act_id)
+        return session.execute(stmt.limit(limit)).all()
+
+    @classmethod
+    def add(cls, session, act, buckets, signature: bytes):
+        """Indexes the buckets of an act and stores its signature, to compare it without its text"""
+        rows = [
+            {"band": band, "bucket": bucket, "act_id": act.id, "court_id": act.court_id, "date": act.date}
+            for band, bucket in enumerate(buckets)
+        ]
+        session.execute(pg_insert(cls).values(rows).on_conflict_do_nothing())
+        # a core update, the search vector of the text is not computed again
+        ActText = models.ActText
+        session.execute(update(ActText).where(ActText.act_id == act.id).values(signature=signature))
+
+    @classmethod
+    def get_unindexed(cls, session, since: dt.date, limit: int, after_id: int = 0):
+        """Acts processed since a date without fingerprints, by id, with their text"""
+        act = models.Act
+        indexed = select(cls.act_id).where(cls.act_id == act.id).exists()
+        stmt = select(act).where(
+            and_(act.id > after_id, act.date >= since, act.processed_at.is_not(None), ~indexed)
+        ).options(joinedload(act.body))
+        return session.execute(stmt.order_by(act.id).limit(limit)).scalars().all()
+
+    @classmethod
+    def prune(cls, session, older_than: dt.date) -> int:
+        """Forgets the acts older than older_than, the index only covers the recent ones"""
+        count = session.execute(delete(cls).where(cls.date < older_than)).rowcount
+        session.commit()
+        log.info(f"Pruned {count} act fingerprints older than {older_than}", extra={"tag": "DB"})
+        return count
+
+
 class UserReportHelper:
     @classmethod
     def get_by_id(cls, session, user_id: int, act_id: int):
@@ -175,18 +421,154 @@ class MessageHelper:
         session.add(msg)
         session.commit()
 
+    @classmethod
+    def from_act(cls, act, text: str, reply_markup: str, user_id: int = None, username: str = None, **kwargs):
+        """Builds a ready to send notification, the payload is never rendered again by Postman"""
+        return cls(
+            act_id=act.id,
+            text=text,
+            reply_markup=reply_markup,
+            short_url=act.get_deeplink(),
+            user_id=user_id,
+            username=username,
+            **kwargs
+        )
+
+    def render(self):
+        """Renders the payload of messages queued before it was stored with the message"""
+        if self.act_id and self.reply_markup is None:
+            self.short_url = self.act.get_deeplink()
+            self.reply_markup = self.act.get_message_markup(private=bool(self.user_id))
+
+    @staticmethod
+    def get_flow(act_id: int = None, user_id: int = None, username: str = None, priority: int = None) -> str:
+        """Every priority class of an act broadcast and every other recipient is a separate flow"""
+        return f"a{act_id}p{int(priority or 0)}" if act_id else f"c{user_id or ''}{username or ''}"
+
+    @classmethod
+    def get_flow_expression(cls):
+        """get_flow in SQL"""
+        return case(
+            (cls.act_id.is_not(None), func.concat("a", cls.act_id, "p", func.coalesce(cls.priority, 0))),
+            else_=func.concat("c", cls.user_id, cls.username),
+        )
+
+    @classmethod
+    def get_virtual_time(cls, session) -> float:
+        """Finish time of the head of the queue, or of the last message queued when the queue is empty"""
+        head = select(cls.finish).where(and_(cls.sent == false(), cls.error.is_(None))).order_by(
+            cls.finish.asc()
+        ).limit(1).scalar_subquery()
+        last = select(func.max(models.MessageFlow.last_finish)).scalar_subquery()
+        return session.execute(select(func.coalesce(head, last, 0.0))).scalar()
+
+    @classmethod
+    def assign_finish(cls, session, messages):
+        """
+        Virtual finish times of new messages in the weighted fair queue: the next message of a flow finishes
+        1 / weight after the later of the current virtual time and the last message of the flow.
+        A large broadcast is interleaved with the other flows instead of being sent before them, and its
+        premium recipients are a flow of their own, not queued behind the regular ones of the same act.
+        """
+        flows = {}
+        for msg in messages:
+            flows.setdefault(cls.get_flow(msg.act_id, msg.user_id, msg.username, msg.priority), []).append(msg)
+        now = cls.get_virtual_time(session)
+        Flow = models.MessageFlow
+        last = dict(session.execute(select(Flow.flow, Flow.last_finish).where(Flow.flow.in_(flows))).all())
+        rows = []
+        for flow, msgs in flows.items():
+            finish = max(now, last.get(flow, now))
+            for msg in msgs:
+                finish += 1.0 / models.PRIORITY_WEIGHTS.get(msg.priority or models.MessagePriorities.regular, 1)
+                msg.finish = finish
+            rows.append({"flow": flow, "last_finish": finish})
+        stmt = pg_insert(Flow).values(rows)
+        last_finish = func.greatest(Flow.last_finish, stmt.excluded.last_finish)
+        session.execute(stmt.on_conflict_do_update(index_elements=[Flow.flow], set_={"last_finish": last_finish}))
+
+    @classmethod
+    def prune_flows(cls, session) -> int:
+        """Forgets the flows behind the virtual time, their next message would start from it anyway"""
+        now = cls.get_virtual_time(session)
+        count = session.execute(delete(models.MessageFlow).where(models.MessageFlow.last_finish < now)).rowcount
+        session.commit()
+        log.info(f"Pruned {count} idle message flows", extra={"tag": "DB"})
+        return count
+
+    @classmethod
+    def get_queue_stmt(cls, limit: int):
+        """Unsent messages in weighted fair order, read from ix_messages_queue"""
+        stmt = select(cls).where(and_(cls.sent == false(), cls.error.is_(None)))
+        return stmt.order_by(cls.finish.asc()).limit(limit)
+
+    @classmethod
+    def get_queue(cls, session, limit: int):
+        return session.execute(cls.get_queue_stmt(limit)).scalars().all()
+
+    @classmethod
+    def load_render_acts(cls, session, messages):
+        """Loads in one query the acts of the messages queued without a keyboard, the only ones render() reads"""
+        legacy = [msg for msg in messages if msg.act_id and msg.reply_markup is None]
+        if not legacy:
+            return
+        stmt = select(models.Act).where(models.Act.id.in_({msg.act_id for msg in legacy}))
+        acts = {act.id: act for act in session.execute(stmt.options(*loaders.options("postman_render"))).scalars()}
+        for msg in legacy:
+            set_committed_value(msg, "act", acts.get(msg.act_id))
+
     @classmethod
     def get_by_id(cls, session, id_: int):
-        return session.get(cls, id_)
+        return session.get(cls, id_) or session.get(models.MessageArchive, id_)
 
     @classmethod
     def get_by_tg_ids(cls, session, message_id: int, chat_id: int):
         stmt = select(cls).where(and_(cls.message_id == message_id, cls.chat_id == chat_id))
+        if msg := session.execute(stmt).scalars().one_or_none():
+            return msg
+        archive = models.MessageArchive
+        stmt = select(archive).where(and_(archive.message_id == message_id, archive.chat_id == chat_id))
         return session.execute(stmt).scalars().one()
 
+    @classmethod
+    def archive(cls, session, older_than: dt.timedelta, batch_size: int) -> int:
+        """
+        Moves sent and deleted messages older than older_than to messages_archive.
+        Every batch is a single DELETE ... RETURNING -> INSERT statement committed on its own, rows
+        locked by Postman are skipped so the queue is never blocked.
+        """
+        columns = [c.name for c in models.MessageArchive.__table__.columns if c.name != "archived_at"]
+        table = cls.__table__
+        total = 0
+        while True:
+            batch = select(table.c.id).where(
+                and_(
+                    or_(table.c.sent == true(), table.c.deleted == true()),
+                    func.coalesce(table.c.sent_at, table.c.timestamp) < func.now() - older_than,
+                )
+            ).order_by(table.c.id).limit(batch_size).with_for_update(skip_locked=True)
+            moved = delete(table).where(table.c.id.in_(batch.scalar_subquery())).returning(
+                *[table.c[c] for c in columns]
+            ).cte("moved")
+            stmt = insert(models.MessageArchive).from_select(columns, select(*[moved.c[c] for c in columns]))
+            count = session.execute(stmt).rowcount
+            session.commit()
+            total += count
+            if count < batch_size:
+                break
+        log.info(f"Archived {total} messages older than {older_than}", extra={"tag": "DB"})
+        return total
+
 
 class DocHelper:
+    @classmethod
+    def get_by_info_id_stmt(cls, info_id: int):
+        return select(cls).where(cls.info_id == info_id).order_by(cls.type)
+
     @classmethod
     def get_by_info_id(cls, session, info_id: int):
-        stmt = select(cls).where(cls.info_id == info_id).order_by(cls.type)
-        return session.execute(stmt).scalars().all()
+        return session.execute(cls.get_by_info_id_stmt(info_id)).scalars().all()
+
+    @classmethod
+    async def aget_by_info_id(cls, session, info_id: int):
+        return (await session.execute(cls.get_by_info_id_stmt(info_id))).scalars().all()
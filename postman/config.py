@@ -7,11 +7,13 @@ class PostmanConfig:
     poll_time = environ.var(help="Time in seconds between updates", converter=int)
     batch_size = environ.var(help="Number of messages to process before going back to sleep", converter=int)
     attempts = environ.var(help="Max retries", converter=int)
+    flush_size = environ.var(
+        default=20, help="Max number of sent messages before their status is saved", converter=int
+    )
+    send_interval = environ.var(default=3000, help="Milliseconds to wait after each message", converter=int)
+    flush_interval = environ.var(default=5, help="Max seconds before the sent status is saved", converter=int)
+    retention_days = environ.var(
+        default=30, help="Days before sent messages are archived, 0 disables the retention", converter=int
+    )
+    retention_batch = environ.var(default=1000, help="Messages archived per transaction", converter=int)
     token = environ.var(name="TBOT_TG_MAIN_TOKEN")
-
-    @environ.config
-    class Url:
-        templates = environ.var(name="TBOT_TG_URL_TEMPLATES")
-        deeplink = environ.var(name="TBOT_TG_MAIN_DEEPLINK")
-
-    url = environ.group(Url)
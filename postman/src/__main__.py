@@ -26,6 +26,11 @@ def main():
         attempts=config.attempts,
         config_poll_time=config.poll_time,
         batch_size=config.batch_size,
+        flush_size=config.flush_size,
+        flush_interval=config.flush_interval,
+        send_interval=config.send_interval,
+        retention_days=config.retention_days,
+        retention_batch=config.retention_batch,
     )
     msg.poll()
 
@@ -0,0 +1,100 @@
+import statistics
+import time
+
+import click
+from sqlalchemy import and_, delete, func
+from sqlalchemy.future import select
+from sqlalchemy.sql.expression import false
+from telebot import apihelper
+
+from database.database import SessionFactory
+from database.models import Message
+from logger.logger import log
+from postman.src.fakeapi import GLOBAL_RATE, FakeBotApi
+from postman.src.postman import Postman
+
+FIRST_CHAT_ID = 10**9
+
+
+def percentile(values, p: int):
+    if len(values) < 2:
+        return values[0] if values else 0
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+def seed(n: int, chats: int):
+    with SessionFactory() as session:
+        messages = [
+            Message(text=f"<b>Benchmark</b> message {i}", username=str(FIRST_CHAT_ID + i % chats), url_preview=False)
+            for i in range(n)
+        ]
+        session.add_all(messages)
+        session.commit()
+        return [m.id for m in messages]
+
+
+def pending_count():
+    with SessionFactory() as session:
+        stmt = select(func.count(Message.id)).where(and_(Message.sent == false(), Message.error.is_(None)))
+        return session.execute(stmt).scalar()
+
+
+@click.command()
+@click.option("--messages", "-n", default=1000, help="Number of messages to seed")
+@click.option("--chats", default=100, help="Number of distinct recipients")
+@click.option("--latency", default=50, help="Fake API latency in milliseconds")
+@click.option("--forbidden", default=0.01, help="Share of recipients that blocked the bot")
+@click.option("--batch-size", default=100)
+@click.option("--flush-size", default=20)
+@click.option("--send-interval", default=0, help="Milliseconds to wait after each message")
+@click.option("--attempts", default=3)
+@click.option("--port", default=8081)
+@click.option("--keep", is_flag=True, help="Keep the seeded messages")
+def main(messages, chats, latency, forbidden, batch_size, flush_size, send_interval, attempts, port, keep):
+    """
+    Drains N seeded messages through Postman against a local fake Bot API, offline.
+    Postman sends whatever is queued, so the benchmark only runs on a scratch database with an empty queue:
+    real notifications would be "delivered" to the fake API and marked as sent.
+    """
+    if pending := pending_count():
+        raise click.ClickException(f"{pending} messages are already queued, use a scratch database")
+    blocked = [FIRST_CHAT_ID + i for i in range(int(chats * forbidden))]
+    api = FakeBotApi(latency=latency, forbidden=blocked)
+    apihelper.API_URL = api.start(port=port)
+    postman = Postman(
+        token="0:benchmark",
+        attempts=attempts,
+        config_poll_time=0,
+        batch_size=batch_size,
+        flush_size=flush_size,
+        flush_interval=5,
+        send_interval=send_interval,
+        retention_days=0,
+        retention_batch=0,
+    )
+    ids = seed(messages, chats)
+    log.info(f"Seeded {len(ids)} messages for {chats} chats", extra={"tag": "BENCH"})
+    start = time.monotonic()
+    try:
+        while postman.process_batch():
+            pass
+    finally:
+        drain_time = time.monotonic() - start
+        api.stop()
+        if not keep:
+            with SessionFactory() as session:
+                session.execute(delete(Message).where(Message.id.in_(ids)))
+                session.commit()
+    latencies = sorted(sent_at - start for sent_at, _ in api.sent)
+    click.echo(f"Messages:        {messages} ({len(api.sent)} delivered, {api.errors[403]} blocked)")
+    click.echo(f"Drain time:      {drain_time:.2f} s ({len(api.sent) / drain_time:.1f} msg/s)")
+    click.echo(
+        f"Latency:         p50 {percentile(latencies, 50):.2f} s - p95 {percentile(latencies, 95):.2f} s - "
+        f"p99 {percentile(latencies, 99):.2f} s"
+    )
+    click.echo(f"Peak rate:       {api.max_rate()} msg/s (limit {GLOBAL_RATE})")
+    click.echo(f"429 responses:   {api.errors[429]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import asyncio
+import itertools
+import threading
+import time
+from collections import defaultdict, deque
+
+from aiohttp import web
+
+from logger.logger import log
+
+# Telegram limits for bots: ~30 messages per second overall and 1 per second in the same chat
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+
+
+class FakeBotApi():
+    """
+    Local stand-in of the Telegram Bot API implementing sendMessage and deleteMessage.
+    Every request waits `latency` milliseconds, chats in `forbidden` answer 403 and requests
+    over the Telegram rate limits answer 429 with retry_after, like the real API.
+    """
+
+    def __init__(self, latency: int = 50, forbidden=(), global_rate: int = GLOBAL_RATE, chat_rate: int = CHAT_RATE):
+        self.latency = latency
+        self.forbidden = {str(chat_id) for chat_id in forbidden}
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.message_ids = itertools.count(1)
+        self.window = deque()
+        self.last_by_chat = {}
+        self.sent = []
+        self.deleted = 0
+        self.errors = defaultdict(int)
+        self.loop = None
+        self.runner = None
+        self.role = "FAKE"
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        return app
+
+    @staticmethod
+    def error(code: int, description: str, **parameters) -> web.Response:
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body, status=code)
+
+    def rate_limit(self, chat_id: str, now: float):
+        """Returns the seconds to wait if the message goes over the rate limits"""
+        while self.window and now - self.window[0] >= 1:
+            self.window.popleft()
+        if len(self.window) >= self.global_rate:
+            return 1
+        last = self.last_by_chat.get(chat_id)
+        if last is not None and now - last < 1 / self.chat_rate:
+            return 1
+        return 0
+
+    async def handle(self, request):
+        params = dict(request.query)
+        if request.content_type == "application/json":
+            params.update(await request.json())
+        else:
+            params.update(await request.post())
+        await asyncio.sleep(self.latency / 1000)
+        method = request.match_info["method"]
+        if method == "sendMessage":
+            return self.send_message(params)
+        if method == "deleteMessage":
+            self.deleted += 1
+            return web.json_response({"ok": True, "result": True})
+        self.errors[404] += 1
+        return self.error(404, "Not Found: method not found")
+
+    def send_message(self, params) -> web.Response:
+        chat_id = str(params.get("chat_id"))
+        if chat_id in self.forbidden:
+            self.errors[403] += 1
+            return self.error(403, "Forbidden: bot was blocked by the user")
+        now = time.monotonic()
+        if retry_after := self.rate_limit(chat_id, now):
+            self.errors[429] += 1
+            return self.error(429, f"Too Many Requests: retry after {retry_after}", retry_after=retry_after)
+        self.window.append(now)
+        self.last_by_chat[chat_id] = now
+        self.sent.append((now, chat_id))
+        result = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id) if chat_id.lstrip("-").isdigit() else 0, "type": "private"},
+            "text": params.get("text", ""),
+        }
+        return web.json_response({"ok": True, "result": result})
+
+    def max_rate(self) -> int:
+        """Highest number of messages accepted in any 1 second window"""
+        best = 0
+        window = deque()
+        for sent_at, _ in self.sent:
+            window.append(sent_at)
+            while sent_at - window[0] >= 1:
+                window.popleft()
+            best = max(best, len(window))
+        return best
+
+    def start(self, host: str = "127.0.0.1", port: int = 8081):
+        """Runs the server in a background thread"""
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        async def run():
+            self.runner = web.AppRunner(self.app())
+            await self.runner.setup()
+            await web.TCPSite(self.runner, host, port).start()
+            started.set()
+
+        def target():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(run())
+            self.loop.run_forever()
+
+        threading.Thread(target=target, daemon=True).start()
+        started.wait()
+        log.info(f"Fake Bot API listening on {host}:{port}", extra={"tag": self.role})
+        return f"http://{host}:{port}/bot{{0}}/{{1}}"
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
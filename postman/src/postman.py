@@ -1,32 +1,50 @@
 import datetime as dt
 import sys
+import time
 
 import pause
-import requests
 import telebot
-from sqlalchemy import and_
-from sqlalchemy.future import select
-from sqlalchemy.sql.expression import false
+from sqlalchemy import update
+from telebot.apihelper import ApiTelegramException
 
-from database.database import SessionFactory
-from database.models import Message
+from database.budget import query_budget
+from database.database import SessionFactory, pool_stats
+from database.models import Message, MessagePriorities
 from logger.logger import log
-from postman.config import PostmanConfig
 
-config = PostmanConfig.from_environ()
+# seconds between two runs of the message retention
+RETENTION_INTERVAL = 3600
 
 
 class Postman():
-    def __init__(self, token: str, attempts: int, config_poll_time: int, batch_size: int):
+    def __init__(
+        self,
+        token: str,
+        attempts: int,
+        config_poll_time: int,
+        batch_size: int,
+        flush_size: int,
+        flush_interval: int,
+        send_interval: int,
+        retention_days: int,
+        retention_batch: int,
+    ):
         self.token = token
         self.attempts = attempts
+        self.send_interval = send_interval
         self.config_poll_time = config_poll_time
         self.poll_time = config_poll_time
         self.batch_size = batch_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        self.results = []
+        self.retention_days = retention_days
+        self.retention_batch = retention_batch
+        self.last_archive = None
         self.msg = None
         self.messages = None
         self.bot = telebot.TeleBot(self.token, threaded=False)
-        self.templates = requests.get(config.url.templates, timeout=60).json()
         self.role = "POST"
 
     def update_poll_time(self, increase=False):
@@ -35,34 +53,45 @@ class Postman():
             self.poll_time += 1
             log.info(f"Increased poll time {time_before} -> {self.poll_time}", extra={"tag": self.role})
         elif not increase and self.poll_time > 0:
-            if self.msg.priority > 0:
+            if self.msg.priority == MessagePriorities.admin:
                 self.poll_time = 0
             else:
                 self.poll_time -= 1
             log.info(f"Decreased poll time {time_before} -> {self.poll_time}", extra={"tag": self.role})
 
+    @property
+    def resend_window(self):
+        """Max number of sent messages whose status can be lost in a crash and sent again"""
+        return min(self.flush_size, self.batch_size)
+
+    def record_result(self, **values):
+        self.results.append({"id": self.msg.id, **values})
+
+    def flush_results(self, session, force=False):
+        """Writes back the buffered send results with a single bulk UPDATE"""
+        if not self.results:
+            return
+        elapsed = time.monotonic() - self.last_flush
+        if not force and len(self.results) < self.flush_size and elapsed < self.flush_interval:
+            return
+        session.execute(update(Message), self.results)
+        session.commit()
+        log.info(f"Saved results of {len(self.results)} messages", extra={"tag": self.role})
+        self.results = []
+        self.last_flush = time.monotonic()
+
     def poll(self):
+        log.info(
+            f"Results are saved every {self.flush_size} messages or {self.flush_interval} seconds, "
+            f"up to {self.resend_window} messages can be sent again after a crash",
+            extra={"tag": self.role}
+        )
         try:
             while True:
-                with SessionFactory() as session:
-                    stmt = select(Message).where(
-                        and_(Message.sent == false(), Message.error.is_(None))
-                    ).order_by(Message.priority.desc(), Message.timestamp.asc()).limit(self.batch_size)
-                    self.messages = session.execute(stmt).scalars().all()
-                    log.info(f"Processing {len(self.messages)} messages", extra={"tag": self.role})
-                    if not self.messages:
-                        self.update_poll_time(increase=True)
-                    for msg in self.messages:
-                        self.msg = msg
-                        self.update_poll_time()
-                        kb = None
-                        if msg.act:
-                            msg.short_url = config.url.deeplink.format(msg.act.uuid)
-                            has_docs = len(msg.act.info.docs) > 0
-                            kb = self.get_kb(has_docs=has_docs)
-                            session.flush()
-                        self.send_message(kb, disable_preview=(not msg.url_preview))
-                        session.commit()
+                if not self.process_batch():
+                    self.archive_messages()
+                else:
+                    log.info(f"Connection pool {pool_stats()}", extra={"tag": self.role})
                 log.info(
                     f"Finished sending messages, going to sleep for {self.poll_time} seconds",
                     extra={"tag": self.role}
@@ -70,37 +99,43 @@ class Postman():
                 pause.seconds(self.poll_time)
         except KeyboardInterrupt:
             log.info("Got KeyboardInterrupt, quitting", extra={"tag": self.role})
+            with SessionFactory() as session:
+                self.flush_results(session, force=True)
             sys.exit(0)
 
-    def get_kb(self, has_docs=False):
-        kb = telebot.types.InlineKeyboardMarkup(row_width=2)
-        btn_layout = []
-        if self.msg.user_id:
-            btn_layout.append(
-                telebot.types.InlineKeyboardButton(
-                    self.templates["italian"]["keyboard"]["inline_buttons"]["details"],
-                    callback_data=f"a.info:{self.msg.act.uuid}"
-                )
-            )
-        else:
-            btn_layout.append(
-                telebot.types.InlineKeyboardButton(
-                    self.templates["italian"]["keyboard"]["inline_buttons"]["details"],
-                    url=self.msg.short_url,
-                )
-            )
-            if has_docs:
-                btn_layout.append(
-                    telebot.types.InlineKeyboardButton(
-                        self.templates["italian"]["keyboard"]["inline_buttons"]["docs"],
-                        url=config.url.deeplink.format(f"docs-{self.msg.act.uuid}")
-                    )
+    def archive_messages(self):
+        """Keeps the queue small moving old sent messages to the archive, at most once per interval"""
+        if self.last_archive and time.monotonic() - self.last_archive < RETENTION_INTERVAL:
+            return
+        with SessionFactory() as session:
+            Message.prune_flows(session)
+            if self.retention_days:
+                Message.archive(
+                    session, older_than=dt.timedelta(days=self.retention_days), batch_size=self.retention_batch
                 )
-        kb.add(*btn_layout)
-        return kb
+        self.last_archive = time.monotonic()
 
-    def send_message(self, kb, disable_preview=False):
+    def process_batch(self) -> int:
+        with SessionFactory() as session:
+            with query_budget("Postman queue", 1):
+                self.messages = Message.get_queue(session, limit=self.batch_size)
+            with query_budget("Postman render", 1):
+                Message.load_render_acts(session, self.messages)
+            log.info(f"Processing {len(self.messages)} messages", extra={"tag": self.role})
+            if not self.messages:
+                self.update_poll_time(increase=True)
+            for msg in self.messages:
+                self.msg = msg
+                self.update_poll_time()
+                msg.render()
+                self.send_message()
+                self.flush_results(session)
+            self.flush_results(session, force=True)
+        return len(self.messages)
+
+    def send_message(self):
         attempts = 0
+        error = None
         dest = self.msg.user_id or self.msg.username
         while attempts <= self.attempts:
             try:
@@ -108,26 +143,42 @@ class Postman():
                 result = self.bot.send_message(
                     text=self.msg.text,
                     chat_id=dest,
-                    parse_mode="html",
-                    reply_markup=kb,
-                    disable_web_page_preview=disable_preview
+                    parse_mode=self.msg.parse_mode,
+                    reply_markup=self.msg.reply_markup,
+                    disable_web_page_preview=not self.msg.url_preview
                 )
+            except ApiTelegramException as e:
+                error = repr(e)
+                if e.error_code == 403:
+                    log.warning(f"Recipient blocked the bot {self.msg}", extra={"tag": self.role})
+                    break
+                if e.error_code == 429:
+                    retry_after = e.result_json.get("parameters", {}).get("retry_after", 5)
+                    log.warning(f"Rate limited, retrying in {retry_after} seconds", extra={"tag": self.role})
+                    pause.seconds(retry_after)
+                    continue
+                log.exception(f"Error while sending message {self.msg}", extra={"tag": self.role})
+                pause.milliseconds(5000 * attempts)
             except Exception as e:
-                self.msg.error = repr(e)
+                error = repr(e)
                 log.exception(f"Error while sending message {self.msg}", extra={"tag": self.role})
                 pause.milliseconds(5000 * attempts)
             else:
-                self.msg.sent = True
-                self.msg.sent_at = dt.datetime.now()
-                self.msg.message_id = result.message_id
-                self.msg.chat_id = result.chat.id
+                self.record_result(
+                    sent=True,
+                    sent_at=dt.datetime.now(),
+                    message_id=result.message_id,
+                    chat_id=result.chat.id,
+                    error=error,
+                )
                 log.info(f"Successfully sent message {self.msg}", extra={"tag": self.role})
-                pause.milliseconds(3000)
-                break
+                pause.milliseconds(self.send_interval)
+                return
+        self.record_result(error=error)
 
     def delete_message(self, message_id: int):
         with SessionFactory() as session:
-            result = session.get(Message, message_id)
+            result = Message.get_by_id(session, message_id)
             if not result:
                 raise Exception("Message not found")
             try:
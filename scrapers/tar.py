@@ -7,7 +7,7 @@ from bs4 import BeautifulSoup
 from sqlalchemy.future import select
 
 from database.database import SessionFactory
-from database.models import Act, ActInfo, Court, Doc
+from database.models import Act, ActInfo, Court, CourtStats, Doc
 from logger.logger import log
 
 URL_LIST = "https://www.giustizia-amministrativa.it/web/guest/dcsnprr"
@@ -87,6 +87,7 @@ class Scraper():
         session.flush()  # populates id
         act.set_properties()
         act.notify = send_notification
+        CourtStats.increment(session, act.court_id, act_count=1)
         session.commit()
         log.info(f"New act: {act}", extra={"tag": self.role})
         return False
@@ -138,3 +139,5 @@ class Scraper():
                 self.scan_court()
             except Exception:
                 log.exception(f"Error while scanning {t}", extra={"tag": self.role})
+        with SessionFactory() as session:
+            CourtStats.refresh(session)
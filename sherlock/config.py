@@ -5,9 +5,12 @@ import environ
 class SherlockConfig:
     sentry = environ.var()
 
-    keywords = environ.var(help="Amazon S3 URL", default=None)
-
     poll_time = environ.var(help="Time in seconds between updates", converter=int)
     batch_size = environ.var(help="Number of permits to process before going back to sleep", converter=int)
+    chunk_size = environ.var(default=50, help="Number of permits fetched from the database at once", converter=int)
+    dedup_threshold = environ.var(
+        default=0.8, help="Text similarity over which an act is a duplicate of a recent one", converter=float
+    )
+    dedup_days = environ.var(default=365, help="Days of acts checked for duplicates", converter=int)
 
     tg_channel_id = environ.var(name="TBOT_TG_CHANNEL_CHAT_ID")
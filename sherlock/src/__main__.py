@@ -8,6 +8,7 @@ from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
 from logger.logger import log
 from sherlock.config import SherlockConfig
 from sherlock.src._sherlock import Sherlock
+from store.store import keywords
 
 config = SherlockConfig.from_environ()
 
@@ -23,9 +24,12 @@ sentry_sdk.init(
 def main():
     log.info("Starting Sherlock", extra={"tag": "SHE"})
     sherlock = Sherlock(
-        keywords=config.keywords,
+        keywords=keywords,
         config_poll_time=config.poll_time,
         batch_size=config.batch_size,
+        chunk_size=config.chunk_size,
+        dedup_threshold=config.dedup_threshold,
+        dedup_days=config.dedup_days,
         tg_channel_id=config.tg_channel_id
     )
     sherlock.poll()
@@ -1,29 +1,55 @@
 import re
+import resource
+import time
+from datetime import date
 from datetime import datetime as dt
+from datetime import timedelta
 
 import pause
-import requests
 from fuzzywuzzy import fuzz, process  # type: ignore
-from sqlalchemy import and_
-from sqlalchemy.future import select
-from sqlalchemy.sql.expression import null
 
-from database.database import SessionFactory
-from database.models import Act, Message, Tracking
+from database.budget import query_budget
+from database.database import SessionFactory, pool_stats
+from database.loaders import options
+from database.models import Act, ActFingerprint, CourtStats, Message, MessagePriorities, Tracking
 from logger.logger import log
+from sherlock.src import minhash
 
 RE_HTML = r"<.*?>"
 RE_WHITESPACE = r"\s+|„|“|”|\.{2,}| {2,}"
+# acts sharing LSH buckets whose text is compared, the ones sharing more bands first
+MAX_CANDIDATES = 3
+# seconds between two prunings of the old fingerprints
+PRUNE_INTERVAL = 3600
+
+
+def get_peak_rss() -> int:
+    """Peak resident memory of the process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
 
 
 class Sherlock():
-    def __init__(self, keywords: str, config_poll_time: int, batch_size: int, tg_channel_id: int):
-        self.keywords = requests.get(keywords, timeout=60).json() if keywords else []
+    def __init__(
+        self,
+        keywords,
+        config_poll_time: int,
+        batch_size: int,
+        chunk_size: int,
+        dedup_threshold: float,
+        dedup_days: int,
+        tg_channel_id: int,
+    ):
+        self.keywords = keywords
         self.config_poll_time = config_poll_time
         self.poll_time = config_poll_time
         self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.dedup_threshold = dedup_threshold
+        self.dedup_days = dedup_days
+        self.last_prune = None
+        # id of the last act of the running pass of index_fingerprints, None between passes
+        self.index_after = None
         self.act = None
-        self.batch = []
         self.tg_channel_id = tg_channel_id
         self.role = "SHE"
 
@@ -38,40 +64,138 @@ class Sherlock():
 
     def poll(self):
         while True:
-            with SessionFactory() as session:
-                # UPDATE permits SET processed_at = TO_TIMESTAMP('2021-01-01', 'YYYY-MM-DD')
-                stmt = select(Act).where(and_(Act.processed_at == null(), Act.error.is_(None))).order_by(
-                    Act.timestamp.asc()
-                ).limit(self.batch_size)
-                self.batch = session.execute(stmt).scalars().all()
-                log.info(f"Processing {len(self.batch)} acts", extra={"tag": self.role})
-                if not self.batch:
-                    self.update_poll_time(increase=True)
-                for act in self.batch:
-                    self.update_poll_time()
-                    self.act = act
-                    log.info(self.act)
-                    start_time = dt.now()
-                    try:
-                        self.clean()
-                        self.evaluate()
-                    except Exception as e:
-                        self.act.error = repr(e)
-                        log.exception(f"Error while processing act {self.act}", extra={"tag": self.role})
-                        session.commit()
-                        continue
-                    if self.act.notify:
-                        log.info("Creating messages", extra={"tag": self.role})
-                        self.create_messages(session)
-                    end_time = dt.now()
-                    self.act.process_time = end_time - start_time
-                    self.act.processed_at = end_time
-                    session.commit()
+            processed = self.process_batch()
+            if not processed:
+                self.update_poll_time(increase=True)
+                self.prune_fingerprints()
+                self.index_fingerprints()
+            else:
+                log.info(f"Connection pool {pool_stats()}", extra={"tag": self.role})
             log.info(
                 f"Finished processing acts, going to sleep for {self.poll_time} seconds", extra={"tag": self.role}
             )
             pause.seconds(self.poll_time)
 
+    def process_batch(self) -> int:
+        """
+        Processes up to batch_size acts, chunk_size at a time. Every chunk is committed on its own, so its
+        messages are sent while the next chunk is processed, and only one chunk is in memory at any time.
+        """
+        processed, last = 0, None
+        while processed < self.batch_size:
+            limit = min(self.chunk_size, self.batch_size - processed)
+            with SessionFactory() as session:
+                # after the last act seen, the acts that failed stay in the queue but aren't fetched again
+                stmt = Act.get_queue_stmt(limit, after=last).options(*options("sherlock_batch"))
+                with query_budget("Sherlock batch", 3):
+                    chunk = session.execute(stmt).scalars().all()
+                for act in chunk:
+                    self.process_safely(session, act)
+                session.commit()
+            self.act = None
+            if not chunk:
+                break
+            last = (chunk[-1].timestamp, chunk[-1].id)
+            processed += len(chunk)
+            log.info(f"Processed {len(chunk)} acts, peak RSS {get_peak_rss()} MB", extra={"tag": self.role})
+            if len(chunk) < limit:
+                break
+        return processed
+
+    def process_safely(self, session, act):
+        """Processes an act in a savepoint, a failure only rolls back (and marks) that act"""
+        try:
+            with session.begin_nested():
+                self.process(session, act)
+        except Exception as e:
+            log.exception(f"Error while processing act {act.id}", extra={"tag": self.role})
+            act.error = repr(e)
+
+    def process(self, session, act):
+        self.update_poll_time()
+        self.act = act
+        log.info(self.act)
+        start_time = dt.now()
+        try:
+            # everything is loaded with the chunk
+            with query_budget("Sherlock act", 0):
+                self.clean()
+                self.evaluate()
+        except Exception as e:
+            self.act.error = repr(e)
+            log.exception(f"Error while processing act {self.act}", extra={"tag": self.role})
+            return
+        try:
+            with session.begin_nested():
+                self.check_duplicate(session)
+        except Exception:
+            # the act is still notified, a failed check only means a possible duplicate
+            log.exception(f"Skipped the duplicate check of act {self.act.id}", extra={"tag": self.role})
+        if self.act.notify and self.act.info.duplicate_of:
+            log.info(f"Not notifying duplicate of act {self.act.info.duplicate_of}", extra={"tag": self.role})
+        elif self.act.notify:
+            log.info("Creating messages", extra={"tag": self.role})
+            self.create_messages(session)
+        if self.act.is_tlc:
+            CourtStats.increment(session, self.act.court_id, act_count_tlc=1)
+        end_time = dt.now()
+        self.act.process_time = end_time - start_time
+        self.act.processed_at = end_time
+        self.act.publish_update(session)
+
+    def check_duplicate(self, session):
+        """Flags the act as a duplicate of a recent act of the same court with a similar text, then indexes it"""
+        sig = minhash.fingerprint(self.act.full_text)
+        if not sig:
+            return
+        buckets = minhash.bands(sig)
+        candidates = ActFingerprint.get_candidates(
+            session, buckets, court_id=self.act.court_id, exclude_id=self.act.id, limit=MAX_CANDIDATES
+        )
+        for act_id, _, signature in candidates:
+            # the stored signatures are compared, the candidate texts are never loaded
+            score = minhash.similarity(sig, minhash.unpack(signature))
+            if score >= self.dedup_threshold:
+                self.act.info.duplicate_of = act_id
+                log.info(f"Act {self.act.id} is similar to act {act_id}: {score:.2f}", extra={"tag": self.role})
+                break
+        ActFingerprint.add(session, self.act, buckets, minhash.pack(sig))
+
+    def get_dedup_since(self) -> date:
+        return date.today() - timedelta(days=self.dedup_days)
+
+    def prune_fingerprints(self):
+        """
+        Keeps the LSH index to the last dedup_days of acts and starts a pass of index_fingerprints,
+        at most once per interval
+        """
+        if self.last_prune and time.monotonic() - self.last_prune < PRUNE_INTERVAL:
+            return
+        with SessionFactory() as session:
+            ActFingerprint.prune(session, older_than=self.get_dedup_since())
+        self.index_after = self.index_after or 0
+        self.last_prune = time.monotonic()
+
+    def index_fingerprints(self) -> int:
+        """
+        Indexes the next chunk of recent acts without fingerprints, after a skipped check or a change of the bands.
+        One chunk per idle poll, a backfill of dedup_days of acts never holds up the queue.
+        """
+        if self.index_after is None:
+            return 0
+        with SessionFactory() as session:
+            acts = ActFingerprint.get_unindexed(
+                session, since=self.get_dedup_since(), limit=self.chunk_size, after_id=self.index_after
+            )
+            for act in acts:
+                if sig := minhash.fingerprint(act.full_text):
+                    ActFingerprint.add(session, act, minhash.bands(sig), minhash.pack(sig))
+            session.commit()
+        self.index_after = acts[-1].id if acts else None
+        if acts:
+            log.info(f"Indexed the fingerprints of {len(acts)} acts", extra={"tag": self.role})
+        return len(acts)
+
     def clean(self):
         try:
             self.act.text = re.sub(RE_HTML, " ", self.act.text)
@@ -92,12 +216,32 @@ class Sherlock():
     def create_messages(self, session):
         text = self.act.get_telegram_text()
         if self.act.is_tlc:
-            user_ids = Tracking.get_users_id(session, court_id=self.act.court_id, only_tlc=True)
-            self.act.messages.append(Message(username=self.tg_channel_id, text=text, url_preview=True))
+            recipients = Tracking.get_recipients(session, court_id=self.act.court_id, only_tlc=True)
+            session.add(
+                Message.from_act(
+                    self.act,
+                    text=text,
+                    reply_markup=self.act.get_message_markup(private=False),
+                    username=self.tg_channel_id,
+                    url_preview=True,
+                    priority=MessagePriorities.channel
+                )
+            )
         else:
-            user_ids = Tracking.get_users_id(session, court_id=self.act.court_id)
-        for u_id in user_ids:
-            self.act.messages.append(Message(user_id=u_id, text=text, url_preview=False))
+            recipients = Tracking.get_recipients(session, court_id=self.act.court_id)
+        # same keyboard for every user, rendered once per act
+        reply_markup = self.act.get_message_markup(private=True)
+        for u_id, is_premium in recipients:
+            session.add(
+                Message.from_act(
+                    self.act,
+                    text=text,
+                    reply_markup=reply_markup,
+                    user_id=u_id,
+                    url_preview=False,
+                    priority=MessagePriorities.premium if is_premium else MessagePriorities.regular
+                )
+            )
 
     def evaluate(self):
         text = self.act.full_text.lower()
@@ -0,0 +1,76 @@
+"""
+MinHash signatures of the act texts and their LSH bands, to find acts published again under another number.
+Two texts with Jaccard similarity s (on word shingles) share at least one band with probability
+1 - (1 - s^ROWS)^BANDS: about 0.12 at s = 0.3, 0.64 at s = 0.5, 0.99 at s = 0.7 and 0.9998 at s = 0.8.
+"""
+import hashlib
+import random
+import re
+import struct
+import zlib
+
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+# words in a shingle
+SHINGLE_SIZE = 5
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+RE_WORD = re.compile(r"\w+")
+
+# fixed seed, the fingerprints stored in the database must not change between runs
+_random = random.Random(20221)
+PERMUTATIONS = [(_random.randrange(1, MERSENNE_PRIME), _random.randrange(0, MERSENNE_PRIME)) for _ in range(NUM_PERM)]
+
+
+def shingles(text: str) -> set:
+    """Hashes of the SHINGLE_SIZE words windows of text, case and punctuation are ignored"""
+    words = RE_WORD.findall(text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {zlib.crc32(" ".join(words).encode("utf-8"))} if words else set()
+    return {
+        zlib.crc32(" ".join(words[i:i + SHINGLE_SIZE]).encode("utf-8"))
+        for i in range(len(words) - SHINGLE_SIZE + 1)
+    }
+
+
+def signature(hashes: set) -> list:
+    """NUM_PERM minimum hashes, empty for an empty set"""
+    if not hashes:
+        return []
+    return [min(((a * h + b) % MERSENNE_PRIME) & MAX_HASH for h in hashes) for a, b in PERMUTATIONS]
+
+
+def bands(sig: list) -> list:
+    """One bucket for each band of ROWS minimum hashes, as signed 64 bit integers"""
+    buckets = []
+    for band in range(BANDS):
+        rows = struct.pack(f"<{ROWS}I", *sig[band * ROWS:(band + 1) * ROWS])
+        digest = hashlib.blake2b(rows, digest_size=8).digest()
+        buckets.append(int.from_bytes(digest, "little", signed=True))
+    return buckets
+
+
+def similarity(sig_a: list, sig_b: list) -> float:
+    """Estimated Jaccard similarity of the texts of two signatures"""
+    if not sig_a or not sig_b:
+        return 0.0
+    return sum(a == b for a, b in zip(sig_a, sig_b)) / NUM_PERM
+
+
+def pack(sig: list) -> bytes:
+    """Signature as stored in the database, 4 bytes per minimum hash"""
+    return struct.pack(f"<{len(sig)}I", *sig)
+
+
+def unpack(data: bytes) -> list:
+    """Stored signature, empty if it is missing or of another number of permutations"""
+    if not data or len(data) != NUM_PERM * 4:
+        return []
+    return list(struct.unpack(f"<{NUM_PERM}I", data))
+
+
+def fingerprint(text: str) -> list:
+    return signature(shingles(text or ""))
@@ -0,0 +1,14 @@
+import environ
+
+
+@environ.config(prefix="TBOT_STORE", frozen=True)
+class StoreConfig:
+    cache_dir = environ.var(default="/tmp/tribunalibot", help="Local copy of the remote json configs")
+    refresh = environ.var(default=300, help="Seconds between two revalidations of the remote configs", converter=int)
+
+    @environ.config
+    class Url:
+        templates = environ.var(name="TBOT_TG_URL_TEMPLATES", default=None)
+        keywords = environ.var(name="TBOT_SHERLOCK_KEYWORDS", default=None)
+
+    url = environ.group(Url)
@@ -0,0 +1,126 @@
+import json
+import os
+import threading
+import time
+from string import Formatter
+
+import requests
+
+from logger.logger import log
+from store.config import StoreConfig
+
+config = StoreConfig.from_environ()
+
+
+def compile_strings(obj):
+    """Parses every format string once, a malformed template fails here instead of inside a handler"""
+    if isinstance(obj, dict):
+        for v in obj.values():
+            compile_strings(v)
+    elif isinstance(obj, list):
+        for v in obj:
+            compile_strings(v)
+    elif isinstance(obj, str):
+        list(Formatter().parse(obj))
+    return obj
+
+
+class JsonStore():
+    """
+    Remote json config shared by every module of the process.
+    It is loaded on first access from the local copy in cache_dir (downloaded only if missing),
+    then a background thread revalidates it with conditional requests and swaps in new versions.
+    """
+
+    def __init__(self, name: str, url: str, cache_dir: str, refresh: int):
+        self.name = name
+        self.url = url
+        self.path = os.path.join(cache_dir, f"{name}.json")
+        self.refresh = refresh
+        self.data = None
+        self.etag = None
+        self.lock = threading.Lock()
+        self.thread = None
+        self.role = "STORE"
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def get(self, key, default=None):
+        return self.load().get(key, default)
+
+    def load(self):
+        if self.data is not None:
+            return self.data
+        with self.lock:
+            if self.data is not None:
+                return self.data
+            start = time.monotonic()
+            if self.read_cache():
+                source = "local cache"
+            elif self.url:
+                self.fetch()
+                source = self.url
+            else:
+                self.data = {}
+                return self.data
+            log.info(
+                f"Loaded {self.name} from {source} in {time.monotonic() - start:.3f} seconds",
+                extra={"tag": self.role}
+            )
+            if self.url:
+                self.thread = threading.Thread(target=self.revalidate, name=f"store-{self.name}", daemon=True)
+                self.thread.start()
+        return self.data
+
+    def read_cache(self) -> bool:
+        try:
+            with open(self.path, "r") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if cached.get("url") != self.url:
+            return False
+        self.data = compile_strings(cached["data"])
+        self.etag = cached.get("etag")
+        return True
+
+    def write_cache(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"url": self.url, "etag": self.etag, "data": self.data}, f)
+        os.replace(tmp_path, self.path)
+
+    def fetch(self) -> bool:
+        """Downloads the config if it changed, returns True when a new version was loaded"""
+        headers = {"If-None-Match": self.etag} if self.etag and self.data is not None else {}
+        response = requests.get(self.url, headers=headers, timeout=60)
+        if response.status_code == 304:
+            return False
+        response.raise_for_status()
+        data = compile_strings(response.json())
+        self.etag = response.headers.get("ETag")
+        if data == self.data:
+            return False
+        self.data = data
+        try:
+            self.write_cache()
+        except OSError:
+            log.exception(f"Error while saving {self.name} to {self.path}", extra={"tag": self.role})
+        return True
+
+    def revalidate(self):
+        while True:
+            try:
+                if self.fetch():
+                    log.info(f"Updated {self.name} from {self.url}", extra={"tag": self.role})
+            except Exception:
+                log.exception(
+                    f"Error while revalidating {self.name}, keeping current version", extra={"tag": self.role}
+                )
+            time.sleep(self.refresh)
+
+
+templates = JsonStore("templates", url=config.url.templates, cache_dir=config.cache_dir, refresh=config.refresh)
+keywords = JsonStore("keywords", url=config.url.keywords, cache_dir=config.cache_dir, refresh=config.refresh)
@@ -8,7 +8,7 @@ from sentry_sdk.integrations.logging import LoggingIntegration
 from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
 
 from database.database import SessionFactory
-from database.models import Message
+from database.models import Message, MessagePriorities
 from logger.logger import log
 from scrapers.config.config import ScanConfig
 from scrapers.tar import Scraper
@@ -30,7 +30,9 @@ class Commander:
     def send_and_log(self, text: str):
         log.info(text)
         with SessionFactory() as session:
-            Message.create(session, text=f"<b>{text}</b>", username=config.support_channel, priority=1000)
+            Message.create(
+                session, text=f"<b>{text}</b>", username=config.support_channel, priority=MessagePriorities.admin
+            )
 
     def notify(self, action):
         if action == "end":
@@ -25,8 +25,48 @@ class TelegramConfig:
     @environ.config
     class Url:
         donate = environ.var()
-        templates = environ.var()
+
+    @environ.config
+    class Dispatcher:
+        workers = environ.var(default=8, help="Threads processing the updates", converter=int)
+        queue_size = environ.var(default=100, help="Max updates waiting for each thread", converter=int)
+
+    @environ.config
+    class Flood:
+        dedup_window = environ.var(default=65536, help="Number of recent update ids remembered", converter=int)
+        callback_rate = environ.var(default=2, help="Callbacks per second allowed to each user", converter=float)
+        callback_burst = environ.var(default=5, help="Callbacks a user can send at once", converter=int)
+        users_size = environ.var(default=10000, help="Max users tracked by the rate limiter", converter=int)
+
+    @environ.config
+    class Interactions:
+        queue_size = environ.var(default=10000, help="Max interactions waiting to be saved", converter=int)
+        batch_size = environ.var(default=500, help="Max interactions saved with one insert", converter=int)
+        flush_interval = environ.var(default=5, help="Max seconds an interaction waits", converter=float)
+
+    @environ.config
+    class Inline:
+        min_length = environ.var(default=3, help="Shorter inline queries get no results", converter=int)
+        page_size = environ.var(default=20, help="Results sent for each inline query", converter=int)
+        cache_time = environ.var(default=300, help="Seconds Telegram may cache an inline answer", converter=int)
+
+    @environ.config
+    class Cache:
+        users_size = environ.var(default=10000, help="Max users kept in memory", converter=int)
+        users_ttl = environ.var(default=300, help="Seconds before a cached user is loaded again", converter=int)
+        acts_size = environ.var(default=2000, help="Max rendered acts kept in memory", converter=int)
+        acts_ttl = environ.var(default=3600, help="Seconds before a rendered act is loaded again", converter=int)
+        searches_size = environ.var(default=1000, help="Max searches kept for the result pages", converter=int)
+        searches_ttl = environ.var(default=900, help="Seconds a search can be paged through", converter=int)
+        inline_size = environ.var(default=5000, help="Max inline answers kept in memory", converter=int)
+        inline_ttl = environ.var(default=60, help="Seconds an inline answer is served from memory", converter=int)
+        courts_ttl = environ.var(default=3600, help="Seconds before the courts are loaded again", converter=int)
 
     main = environ.group(Main)
     channel = environ.group(Channel)
     url = environ.group(Url)
+    dispatcher = environ.group(Dispatcher)
+    flood = environ.group(Flood)
+    interactions = environ.group(Interactions)
+    inline = environ.group(Inline)
+    cache = environ.group(Cache)
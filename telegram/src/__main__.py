@@ -2,7 +2,6 @@ import logging
 import random
 
 import pause
-import requests
 import sentry_sdk
 import telebot
 from aiohttp import web
@@ -10,9 +9,18 @@ from sentry_sdk.integrations.logging import LoggingIntegration
 from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
 from telebot.types import BotCommand
 
+from database.database import pool_stats
+from database.events import ACT_UPDATED, USER_UPDATED, Listener
 from logger.logger import log
+from store.store import templates
 from telegram.config import TelegramConfig
+from telegram.src.acts import acts
+from telegram.src.dispatcher import Dispatcher
+from telegram.src.flood import RateLimiter, UpdateWindow
 from telegram.src.handlers import bot
+from telegram.src.inline import inline
+from telegram.src.interactions import recorder
+from telegram.src.users import users
 
 config = TelegramConfig.from_environ()
 
@@ -44,14 +52,38 @@ async def error_middleware(request, handler):
     return web.json_response({'error': message})
 
 
+def process_update(update):
+    # one UPDATE at most per user, whatever the handlers changed
+    with users.batch():
+        bot.process_new_updates([update])
+
+
+dispatcher = Dispatcher(
+    process=process_update, workers=config.dispatcher.workers, queue_size=config.dispatcher.queue_size
+)
+
+
+updates = UpdateWindow(size=config.flood.dedup_window)
+callbacks_limiter = RateLimiter(
+    rate=config.flood.callback_rate, burst=config.flood.callback_burst, maxsize=config.flood.users_size
+)
+
+
 @routes.post('/')
 async def handle(request):
     request_body_dict = await request.json()
     update = telebot.types.Update.de_json(request_body_dict)
-    try:
-        bot.process_new_updates([update])
-    except Exception:
-        log.exception("Bot error", extra={"tag": "TG"})
+    if updates.seen(update.update_id):
+        # redelivered because we answered too late, it is already being processed
+        return web.Response()
+    if update.callback_query and not callbacks_limiter.allow(update.callback_query.from_user.id):
+        # answered in the webhook response, no request to Telegram and no work for the handlers
+        return web.json_response({"method": "answerCallbackQuery", "callback_query_id": update.callback_query.id})
+    if not dispatcher.submit(update):
+        log.warning(f"Update queue full, rejected update {update.update_id}", extra={"tag": "TG"})
+        # Telegram delivers the update again later
+        updates.forget(update.update_id)
+        return web.Response(status=503)
     return web.Response()
 
 
@@ -60,14 +92,42 @@ async def health_check(request):
     return web.Response(text="OK")
 
 
+@routes.get('/stats')
+async def stats(request):
+    return web.json_response(
+        {
+            "dispatcher": dispatcher.stats(),
+            "acts": acts.cache.stats(),
+            "users": users.stats(),
+            "inline": inline.cache.stats(),
+            "interactions": recorder.stats(),
+            "pool": pool_stats(),
+            "flood": {
+                "duplicates": updates.duplicates,
+                "callbacks_allowed": callbacks_limiter.allowed,
+                "callbacks_limited": callbacks_limiter.limited,
+            },
+        }
+    )
+
+
+async def stop_dispatcher(app):
+    dispatcher.stop()
+    recorder.stop()
+
+
 def main():
-    templates = requests.get(config.url.templates).json()
     bot.remove_webhook()
     bot.set_webhook(url=config.main.webhook + config.main.token, drop_pending_updates=True)
     bot.set_update_listener(listener)
     bot.set_my_commands([BotCommand(name, desc) for name, desc in templates["italian"]["commands"].items()])
+    dispatcher.start()
+    recorder.start()
+    Listener(ACT_UPDATED, acts.invalidate).start()
+    Listener(USER_UPDATED, users.invalidate).start()
     app = web.Application(middlewares=[error_middleware], logger=log)
     app.add_routes(routes)
+    app.on_cleanup.append(stop_dispatcher)
     log.info("Bot started", extra={"tag": "TG"})
     web.run_app(
         app,
@@ -0,0 +1,67 @@
+from collections import namedtuple
+
+from database.budget import query_budget
+from database.database import RoutingSessionFactory, recent_writes
+from database.models import Act
+from logger.logger import log
+from store.store import templates
+from telegram.config import TelegramConfig
+from telegram.src import markups
+from telegram.src.cache import TTLCache
+
+config = TelegramConfig.from_environ()
+
+ActView = namedtuple("ActView", ["id", "uuid", "info_id", "text", "kb", "extra", "description"])
+
+
+def render_extra(act) -> str:
+    dct_info = [f"• {k.replace('_', ' ').capitalize()}: <code>{v}</code>" for k, v in act.info.extra_info.items()]
+    isp_text = ""
+    if act.info.isp:
+        isp_list = [isp.title() for isp in act.info.isp.keys()]
+        isp_text = "\n• ISP: <code>" + ", ".join(isp_list) + "</code>"
+    return templates["italian"]["messages"]["extra_info"].format(
+        dct_info="\n".join(dct_info), is_tlc=str(act.is_tlc), isp=isp_text
+    )
+
+
+class ActViewCache():
+    """
+    Acts as shown by the bot, rendered once and kept in memory by uuid.
+    Sherlock notifies every change to an act, the listener started by the bot calls invalidate.
+    """
+
+    def __init__(self, maxsize: int, ttl: int):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.role = "TG"
+
+    def get(self, uuid: str):
+        if view := self.cache.get(uuid):
+            return view
+        with RoutingSessionFactory(info={"writer": ("act", uuid)}) as session, query_budget("Act card", 1):
+            if not (act := Act.get_by_uuid(session, uuid=uuid)):
+                return None
+            view = ActView(
+                id=act.id,
+                uuid=act.uuid,
+                info_id=act.info_id,
+                text=act.get_telegram_text(),
+                kb=markups.act_info(act),
+                extra=render_extra(act),
+                description=str(act),
+            )
+        self.cache.set(uuid, view)
+        return view
+
+    def invalidate(self, uuid: str = None):
+        """Drops an act, or every act, from the cache. The next load of the act reads from the primary"""
+        if uuid is None:
+            self.cache.clear()
+            log.info("Cleared act cache", extra={"tag": self.role})
+            return
+        recent_writes.mark(("act", uuid))
+        if self.cache.pop(uuid):
+            log.info(f"Invalidated cached act {uuid}", extra={"tag": self.role})
+
+
+acts = ActViewCache(maxsize=config.cache.acts_size, ttl=config.cache.acts_ttl)
@@ -0,0 +1,108 @@
+from typing import List, Optional, Tuple
+
+from logger.logger import log
+
+VERSION = "1"
+
+# Telegram rejects buttons whose callback_data is longer than this
+MAX_SIZE = 64
+
+FRAME_SEPARATOR = "/"
+
+CODES = {
+    "a.info": "i",
+    "a.docs": "d",
+    "a.extra": "x",
+    "a.report": "r",
+    "c.info": "c",
+    "c.add": "+",
+    "c.delete": "-",
+    "c.track-all": "A",
+    "c.track-tlc": "T",
+    "c.list": "l",
+    "l.page": "p",
+    "s.page": "s",
+}
+
+ACTIONS = {code: action for action, code in CODES.items()}
+
+
+def decode_legacy(payload: str) -> Tuple[str, Optional[str], Optional[str]]:
+    """Decodes the action:data:back format used before the codec, still found in old messages"""
+    call_data = payload.split(":")
+    action = call_data[0]
+    try:
+        data = call_data[1] if "|" not in call_data[1] else call_data[1].split("|")
+    except IndexError:
+        data = None
+    back = ":".join(call_data[2:]) or None
+    if back == "None":
+        back = None
+    return action, data or None, back
+
+
+def get_frames(back: Optional[str]) -> List[str]:
+    """Frames of an encoded back chain, a legacy chain is converted on the fly"""
+    if not back:
+        return []
+    if back.startswith(VERSION):
+        return back[len(VERSION):].split(FRAME_SEPARATOR)
+    action, data, back = decode_legacy(back)
+    if action not in CODES or isinstance(data, list):
+        return []
+    return [CODES[action] + (data or "")] + get_frames(back)
+
+
+def encode(action: str, data=None, back: str = None) -> str:
+    """
+    Builds the callback_data of a button: version, then frames separated by "/", each frame is
+    the one char action code followed by its data. The frames after the first one are the chain
+    of screens the back button goes through, the oldest are dropped if the payload gets too long.
+    """
+    data = "" if data is None else str(data)
+    if FRAME_SEPARATOR in data:
+        raise ValueError(f"Callback data can't contain '{FRAME_SEPARATOR}': {data}")
+    frames = [CODES[action] + data] + get_frames(back)
+    payload = VERSION + FRAME_SEPARATOR.join(frames)
+    while len(payload.encode()) > MAX_SIZE and len(frames) > 1:
+        frames.pop()
+        payload = VERSION + FRAME_SEPARATOR.join(frames)
+    if len(payload.encode()) > MAX_SIZE:
+        raise ValueError(f"Callback data longer than {MAX_SIZE} bytes: {payload}")
+    return payload
+
+
+def decode(payload: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """Returns action, data and the encoded back chain of a callback_data"""
+    if not payload.startswith(VERSION):
+        return decode_legacy(payload)
+    frames = payload[len(VERSION):].split(FRAME_SEPARATOR)
+    action = ACTIONS.get(frames[0][:1])
+    data = frames[0][1:] or None
+    back = VERSION + FRAME_SEPARATOR.join(frames[1:]) if len(frames) > 1 else None
+    return action, data, back
+
+
+class Router():
+    """Dispatch table from callback actions to their handlers"""
+
+    def __init__(self):
+        self.handlers = {}
+        self.role = "TG"
+
+    def register(self, *actions: str):
+        def decorator(handler):
+            for action in actions:
+                if action in self.handlers:
+                    raise ValueError(f"Action {action} already handled by {self.handlers[action].__name__}")
+                self.handlers[action] = handler
+            return handler
+
+        return decorator
+
+    def dispatch(self, call) -> bool:
+        if not (handler := self.handlers.get(call.action)):
+            log.warning(f"No handler for action '{call.action}'", extra={"tag": self.role})
+            return False
+        handler(call)
+        return True
@@ -0,0 +1,49 @@
+import threading
+import time
+
+from database.database import RoutingSessionFactory
+from database.models import Court
+from telegram.config import TelegramConfig
+
+config = TelegramConfig.from_environ()
+
+
+class CourtCatalog():
+    """Every court sorted by name, courts almost never change so they are loaded again only after ttl seconds"""
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.courts = []
+        self.by_id = {}
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.loaded_at and time.monotonic() - self.loaded_at < self.ttl:
+                return self.courts
+            with RoutingSessionFactory() as session:
+                self.courts = Court.get_all(session)
+            self.by_id = {c.id: c for c in self.courts}
+            self.loaded_at = time.monotonic()
+            return self.courts
+
+    def get(self, court_id: str):
+        self.load()
+        return self.by_id.get(court_id)
+
+    def find(self, name: str):
+        """Court by name, ignoring case, or the only court whose name starts with it"""
+        name = name.strip().lower()
+        courts = self.load()
+        if match := next((c for c in courts if c.name.lower() == name), None):
+            return match
+        matches = [c for c in courts if c.name.lower().startswith(name)]
+        return matches[0] if len(matches) == 1 else None
+
+    def page(self, page: int, page_size: int):
+        courts = self.load()
+        return courts[page * page_size:(page + 1) * page_size], len(courts)
+
+
+catalog = CourtCatalog(ttl=config.cache.courts_ttl)
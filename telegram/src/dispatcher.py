@@ -0,0 +1,106 @@
+import queue
+import statistics
+import threading
+import time
+from collections import deque
+
+from logger.logger import log
+
+# number of recent updates used to compute the latency percentiles
+LATENCY_SAMPLES = 1000
+
+
+def get_chat_id(update) -> int:
+    """Chat the update belongs to, updates of the same chat must be processed in order"""
+    if update.message:
+        return update.message.chat.id
+    if update.edited_message:
+        return update.edited_message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    if update.inline_query:
+        return update.inline_query.from_user.id
+    return update.update_id
+
+
+def percentiles(samples) -> dict:
+    if len(samples) < 2:
+        value = round(samples[0], 4) if samples else 0
+        return {"p50": value, "p95": value}
+    cuts = statistics.quantiles(samples, n=20, method="inclusive")
+    return {"p50": round(cuts[9], 4), "p95": round(cuts[18], 4)}
+
+
+class Dispatcher():
+    """
+    Processes webhook updates on a pool of worker threads so the event loop only enqueues them.
+    Every worker has its own bounded queue and all the updates of a chat go to the same worker,
+    preserving their order.
+    """
+
+    def __init__(self, process, workers: int, queue_size: int):
+        self.process = process
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.threads = []
+        self.latency = deque(maxlen=LATENCY_SAMPLES)
+        self.processing = deque(maxlen=LATENCY_SAMPLES)
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.role = "TG"
+
+    def start(self):
+        for i, q in enumerate(self.queues):
+            thread = threading.Thread(target=self.work, args=(q, ), name=f"dispatcher-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        log.info(f"Started {len(self.threads)} update workers", extra={"tag": self.role})
+
+    def stop(self):
+        for q in self.queues:
+            q.put(None)
+        for thread in self.threads:
+            thread.join()
+        log.info("Stopped update workers", extra={"tag": self.role})
+
+    def submit(self, update) -> bool:
+        """Enqueues an update without blocking, returns False if the worker queue is full"""
+        q = self.queues[get_chat_id(update) % len(self.queues)]
+        try:
+            q.put_nowait((time.monotonic(), update))
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            return False
+        return True
+
+    def work(self, q):
+        while (item := q.get()) is not None:
+            queued_at, update = item
+            started_at = time.monotonic()
+            try:
+                self.process(update)
+            except Exception:
+                log.exception("Bot error", extra={"tag": self.role})
+                with self.lock:
+                    self.failed += 1
+            finished_at = time.monotonic()
+            with self.lock:
+                self.processed += 1
+                self.latency.append(finished_at - queued_at)
+                self.processing.append(finished_at - started_at)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "queue_depth": sum(q.qsize() for q in self.queues),
+                "max_worker_depth": max(q.qsize() for q in self.queues),
+                "processed": self.processed,
+                "rejected": self.rejected,
+                "failed": self.failed,
+                "latency": percentiles(list(self.latency)),
+                "processing": percentiles(list(self.processing)),
+            }
@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class UpdateWindow():
+    """
+    Remembers the update_id already received, in a bitmap of size bits used as a ring.
+    Telegram numbers updates sequentially, so only the last size ids are tracked and anything
+    older is considered already seen.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.bits = bytearray((size + 7) // 8)
+        self.highest = None
+        self.lock = threading.Lock()
+        self.duplicates = 0
+
+    def clear(self, start: int, end: int):
+        """Unsets the bits of the ids from start to end included"""
+        if end - start + 1 >= self.size:
+            self.bits = bytearray(len(self.bits))
+            return
+        for update_id in range(start, end + 1):
+            i = update_id % self.size
+            self.bits[i >> 3] &= ~(1 << (i & 7)) & 0xFF
+
+    def seen(self, update_id: int) -> bool:
+        """Marks update_id as received, returns True if it already was"""
+        with self.lock:
+            if self.highest is None:
+                self.highest = update_id - 1
+            if update_id > self.highest:
+                self.clear(self.highest + 1, update_id)
+                self.highest = update_id
+            elif update_id <= self.highest - self.size:
+                self.duplicates += 1
+                return True
+            i = update_id % self.size
+            mask = 1 << (i & 7)
+            if self.bits[i >> 3] & mask:
+                self.duplicates += 1
+                return True
+            self.bits[i >> 3] |= mask
+            return False
+
+    def forget(self, update_id: int):
+        """Lets update_id through again, for updates rejected before being processed"""
+        with self.lock:
+            if self.highest is not None and update_id > self.highest - self.size:
+                i = update_id % self.size
+                self.bits[i >> 3] &= ~(1 << (i & 7)) & 0xFF
+
+
+class RateLimiter():
+    """Token bucket for each user, rate tokens per second up to burst, the least recent users are forgotten"""
+
+    def __init__(self, rate: float, burst: int, maxsize: int):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+
+    def allow(self, user_id: int) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.pop(user_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+                self.allowed += 1
+            else:
+                self.limited += 1
+            self.buckets[user_id] = (tokens, now)
+            if len(self.buckets) > self.maxsize:
+                self.buckets.popitem(last=False)
+            return allowed
@@ -3,25 +3,31 @@
 import html
 import re
 
-import requests
 import telebot  # type: ignore
 from telebot import apihelper, types
 
-from database.database import SessionFactory
-from database.models import Act, Court, Doc, Message, Tracking, User, UserReport
+from database.database import RoutingSessionFactory
+from database.models import Court, CourtStats, Doc, InteractionTypes, Message, MessagePriorities, Tracking, UserReport
 from logger.logger import log
+from store.store import templates
 from telegram.config import TelegramConfig
-from telegram.src import markups
+from telegram.src import callbacks, markups, search
+from telegram.src.acts import acts
+from telegram.src.catalog import catalog
+from telegram.src.inline import inline
+from telegram.src.interactions import recorder
+from telegram.src.users import users
 
 config = TelegramConfig.from_environ()
 
 apihelper.ENABLE_MIDDLEWARE = True
 
-bot = telebot.TeleBot(config.main.token)
+# updates are already processed by the dispatcher threads, one chat at a time
+bot = telebot.TeleBot(config.main.token, threaded=False)
 
 hideBoard = types.ReplyKeyboardRemove()
 
-templates = requests.get(config.url.templates).json()
+router = callbacks.Router()
 
 START_ACT = r"(?<=/start )\w{16,}"
 START_DOCS = r"(?<=/start docs-)\w{16,}"
@@ -33,46 +39,27 @@ def get_match_from_message(text, regex):
 
 @bot.middleware_handler(update_types=['message'])
 def set_user_message(bot_instance, m):
-    with SessionFactory() as session:
-        m.user = User.get_or_create(
-            session,
-            id=m.from_user.id,
-            username=m.from_user.username,
-            firstname=m.from_user.first_name,
-            lastname=m.from_user.last_name,
-            language=m.from_user.language_code,
-        )
+    m.user = users.get_or_create(m.from_user)
+    if m.user:
+        is_command = bool(m.text) and m.text.startswith("/")
+        recorder.record(m.user.id, InteractionTypes.command if is_command else InteractionTypes.message, m.text)
 
 
 @bot.middleware_handler(update_types=['callback_query'])
 def set_user_call(bot_instance, call):
-    call_data = call.data.split(":")
     call.payload = call.data
-    call.action = call_data[0]
-    try:
-        call.data = call_data[1] if "|" not in call_data[1] else call_data[1].split("|")
-    except IndexError:
-        call.data = None
-    call.back = ":".join(call_data[2:]) or None
-    if call.back == "None":
-        call.back = None
+    call.action, call.data, call.back = callbacks.decode(call.payload)
     log.info(f"Got call with action:'{call.action}' - data:'{call.data}' - back:'{call.back}'", extra={"tag": "TG"})
-    with SessionFactory() as session:
-        call.user = User.get_or_create(
-            session,
-            id=call.from_user.id,
-            username=call.from_user.username,
-            firstname=call.from_user.first_name,
-            lastname=call.from_user.last_name,
-            language=call.from_user.language_code,
-        )
+    call.user = users.get_or_create(call.from_user)
+    if call.user:
+        recorder.record(call.user.id, InteractionTypes.button, call.payload)
 
 
 @bot.message_handler(commands=["debug"])
 def debug(m):
-    with SessionFactory() as session:
+    with RoutingSessionFactory(info={"writer": m.user.id}) as session:
         text = templates["italian"]["messages"]["debug"].format(user=html.escape(str(m.user)))
-        Message.create(session, username=config.support.chat_id, text=text, priority=1000)
+        Message.create(session, username=config.support.chat_id, text=text, priority=MessagePriorities.admin)
 
 
 @bot.message_handler(commands=["annulla"])
@@ -85,16 +72,14 @@ def cancel(m):
         parse_mode="html",
         reply_markup=markups.default_buttons()
     )
-    with SessionFactory() as session:
-        User.update_by_id(session, id_=m.user.id, dct={"page": 0, "state": 0})
+    users.update(m.user.id, {"page": 0, "state": 0})
 
 
 @bot.message_handler(commands=["help"])
 @bot.message_handler(func=lambda m: m.text == templates["italian"]["keyboard"]["buttons"]["help"])
 def help_prompt(m):
     """ Sends help message """
-    with SessionFactory() as session:
-        User.update_by_id(session, id_=m.user.id, dct={"state": 0})
+    users.update(m.user.id, {"state": 0})
     commands = "".join(f"\n• /{k} - {v}" for k, v in templates["italian"]["commands"].items())
     text = templates["italian"]["messages"]["help"].format(
         commands=commands, channel_name=config.channel.name, donation_url=config.url.donate
@@ -106,7 +91,7 @@ def help_prompt(m):
 
 # region START
 @bot.message_handler(commands=["start"], regexp=START_ACT)
-@bot.callback_query_handler(func=lambda call: True and call.action == "a.info")
+@router.register("a.info")
 def send_act_info(m):
     try:
         # message already in chat
@@ -117,45 +102,46 @@ def send_act_info(m):
         # deeplink from channel
         uuid = get_match_from_message(m.text, START_ACT)
         edit = False
-    with SessionFactory() as session:
-        User.update_by_id(session, id_=m.user.id, dct={"state": 0})
-        if act := Act.get_by_uuid(session, uuid=uuid):
-            text = act.get_telegram_text()
-            kb = markups.act_info(act)
-            if edit:
-                bot.edit_message_text(
-                    text=text,
-                    chat_id=m.user.id,
-                    message_id=m.message.id,
-                    parse_mode="html",
-                    reply_markup=kb,
-                    disable_web_page_preview=True
-                )
-            else:
-                bot.send_message(
-                    text=text, chat_id=m.chat.id, parse_mode="html", reply_markup=kb, disable_web_page_preview=True
-                )
+    users.update(m.user.id, {"state": 0})
+    if view := acts.get(uuid):
+        if edit:
+            bot.edit_message_text(
+                text=view.text,
+                chat_id=m.user.id,
+                message_id=m.message.id,
+                parse_mode="html",
+                reply_markup=view.kb,
+                disable_web_page_preview=True
+            )
         else:
             bot.send_message(
-                text=templates["italian"]["errors"]["act_not_found"],
+                text=view.text,
                 chat_id=m.chat.id,
                 parse_mode="html",
-                reply_markup=markups.default_buttons()
+                reply_markup=view.kb,
+                disable_web_page_preview=True
             )
+    else:
+        bot.send_message(
+            text=templates["italian"]["errors"]["act_not_found"],
+            chat_id=m.chat.id,
+            parse_mode="html",
+            reply_markup=markups.default_buttons()
+        )
 
 
-@bot.callback_query_handler(func=lambda call: True and call.action == "c.info")
+@router.register("c.info")
 def court_info(m):
     court_id = m.data
     call_answer = templates["italian"]["answers"]["court_info"]
     bot.answer_callback_query(m.id, text=call_answer)
-    with SessionFactory() as session:
-        court = session.get(Court, court_id)
+    with RoutingSessionFactory(info={"writer": m.user.id}) as session:
+        stats = CourtStats.get(session, court_id)
         text = templates["italian"]["messages"]["court_info"].format(
-            court_name=court.name,
-            user_count=court.user_count,
-            act_count=court.act_count,
-            act_count_tlc=court.act_count_tlc,
+            court_name=catalog.get(court_id).name,
+            user_count=stats.user_count if stats else 0,
+            act_count=stats.act_count if stats else 0,
+            act_count_tlc=stats.act_count_tlc if stats else 0,
         )
         tracking = Tracking.get(session, user_id=m.user.id, court_id=court_id)
     kb = markups.court_info(tracking=tracking, court_id=court_id, back=m.back)
@@ -170,7 +156,7 @@ def court_info(m):
 
 
 @bot.message_handler(commands=["start"], regexp=START_DOCS)
-@bot.callback_query_handler(func=lambda call: True and call.action == "a.docs")
+@router.register("a.docs")
 def info_docs(call):
     try:
         # message already in chat
@@ -182,22 +168,21 @@ def info_docs(call):
         # deeplink from channel
         uuid = get_match_from_message(call.text, START_DOCS)
         edit = False
-        call.back = f"a.info:{uuid}"
-    with SessionFactory() as session:
-        if edit:
-            info_id = call.data
-        else:
-            act = Act.get_by_uuid(session, uuid=uuid)
-            if not act:
-                bot.send_message(
-                    text=templates["italian"]["errors"]["act_not_found"],
-                    chat_id=call.chat.id,
-                    parse_mode="html",
-                    reply_markup=markups.default_buttons()
-                )
-                return
-            info_id = act.info_id
-            tg_text = act.get_telegram_text()
+        call.back = callbacks.encode("a.info", uuid)
+    if edit:
+        info_id = call.data
+    else:
+        if not (view := acts.get(uuid)):
+            bot.send_message(
+                text=templates["italian"]["errors"]["act_not_found"],
+                chat_id=call.chat.id,
+                parse_mode="html",
+                reply_markup=markups.default_buttons()
+            )
+            return
+        info_id = view.info_id
+        tg_text = view.text
+    with RoutingSessionFactory(info={"writer": call.user.id}) as session:
         kb = markups.docs_keyboard(docs=Doc.get_by_info_id(session, info_id=info_id), back=call.back)
     if edit:
         bot.edit_message_text(
@@ -224,8 +209,7 @@ def welcome(m):
         bot.reply_to(text=text, message=m, parse_mode="html")
         text = templates["italian"]["messages"]["welcome_2"]
         bot.send_message(text=text, chat_id=m.chat.id, parse_mode="html", reply_markup=markups.default_buttons())
-        with SessionFactory() as session:
-            User.update_by_id(session, id_=m.user.id, dct={"state": 0})
+        users.update(m.user.id, {"state": 0})
     else:
         text = templates["italian"]["errors"]["started"]
         bot.reply_to(text=text, message=m, parse_mode="html", reply_markup=markups.default_buttons())
@@ -236,27 +220,19 @@ def welcome(m):
 # region ACT
 
 
-@bot.callback_query_handler(func=lambda call: True and call.action == "a.extra")
+@router.register("a.extra")
 def info_extra(call):
     call_answer = templates["italian"]["answers"]["extra"]
     bot.answer_callback_query(call.id, text=call_answer)
-    with SessionFactory() as session:
-        act = Act.get_by_uuid(session, uuid=call.data)
-        dct_info = [f"• {k.replace('_', ' ').capitalize()}: <code>{v}</code>" for k, v in act.info.extra_info.items()]
-        isp_text = ""
-        if act.info.isp:
-            isp_list = [isp.title() for isp in act.info.isp.keys()]
-            isp_text = "\n• ISP: <code>" + ", ".join(isp_list) + "</code>"
-        text = templates["italian"]["messages"]["extra_info"].format(
-            dct_info="\n".join(dct_info), is_tlc=str(act.is_tlc), isp=isp_text
-        )
-        hide_report = bool(UserReport.get_by_id(session, user_id=call.user.id, act_id=act.id))
+    view = acts.get(call.data)
+    with RoutingSessionFactory(info={"writer": call.user.id}) as session:
+        hide_report = bool(UserReport.get_by_id(session, user_id=call.user.id, act_id=view.id))
     kb = types.InlineKeyboardMarkup(row_width=1)
     if not hide_report:
         kb.add(
             types.InlineKeyboardButton(
                 templates["italian"]["keyboard"]["inline_buttons"]["report"],
-                callback_data=f"a.report:{call.data}:{call.back}"
+                callback_data=callbacks.encode("a.report", call.data, call.back)
             )
         )
     kb.add(
@@ -265,23 +241,23 @@ def info_extra(call):
         )
     )
     bot.edit_message_text(
-        text=text, chat_id=call.message.chat.id, message_id=call.message.id, parse_mode="html", reply_markup=kb
+        text=view.extra, chat_id=call.message.chat.id, message_id=call.message.id, parse_mode="html", reply_markup=kb
     )
 
 
-@bot.callback_query_handler(func=lambda call: True and call.action == "a.report")
+@router.register("a.report")
 def report_error(call):
-    with SessionFactory() as session:
-        act = Act.get_by_uuid(session, uuid=call.data)
-        result = UserReport.create(session, user_id=call.user.id, act_id=act.id)
-        deeplink = config.main.deeplink.format(act.uuid)
+    view = acts.get(call.data)
+    with RoutingSessionFactory(info={"writer": call.user.id, "primary": True}) as session:
+        result = UserReport.create(session, user_id=call.user.id, act_id=view.id)
+        deeplink = config.main.deeplink.format(view.uuid)
         text = templates["italian"]["messages"]["report_admin"].format(
             user_id=call.user.id,
             username=html.escape(call.user.username),
-            act=html.escape(str(act)),
+            act=html.escape(view.description),
             deeplink=deeplink
         )
-        Message.create(session, username=config.support.chat_id, text=text, priority=1000)
+        Message.create(session, username=config.support.chat_id, text=text, priority=MessagePriorities.admin)
     text = templates["italian"]["messages"]["report-error"] if result else templates["italian"]["messages"]["report"]
     # if not act.is_tlc:
     #     text += "\n\n" + templates["italian"]["messages"]["report_track_all"]
@@ -291,29 +267,98 @@ def report_error(call):
 
 # endregion ACT
 
+# region SEARCH
+
+
+def send_search_page(m, query: search.SearchQuery, page: int, edit: bool):
+    results, count = search.find(query, page=page)
+    if not results:
+        text = templates["italian"]["errors"]["search_empty"]
+        if edit:
+            bot.edit_message_text(text=text, chat_id=m.message.chat.id, message_id=m.message.id, parse_mode="html")
+        else:
+            bot.send_message(text=text, chat_id=m.chat.id, parse_mode="html")
+        return
+    first = page * search.PAGE_SIZE + 1
+    pages = -(-count // search.PAGE_SIZE)
+    lines = [
+        templates["italian"]["messages"]["search_result"].format(
+            n=n, tribunale=r.court_name.upper(), date=r.date.strftime("%d/%m/%Y"), text=html.escape(r.text[:200])
+        ) for n, r in enumerate(results, start=first)
+    ]
+    text = templates["italian"]["messages"]["search_results"].format(
+        count=count, query=html.escape(query.text), page=page + 1, pages=pages, results="\n\n".join(lines)
+    )
+    kb = markups.search_results(results, first=first, page=page, pages=pages)
+    if edit:
+        bot.edit_message_text(
+            text=text,
+            chat_id=m.message.chat.id,
+            message_id=m.message.id,
+            parse_mode="html",
+            reply_markup=kb,
+            disable_web_page_preview=True
+        )
+    else:
+        bot.send_message(
+            text=text, chat_id=m.chat.id, parse_mode="html", reply_markup=kb, disable_web_page_preview=True
+        )
+
 
-@bot.callback_query_handler(func=lambda call: True and call.action == "c.list")
+@bot.message_handler(commands=["cerca"])
+def search_acts(m):
+    users.update(m.user.id, {"state": 0})
+    try:
+        query = search.parse(telebot.util.extract_arguments(m.text))
+    except ValueError:
+        bot.reply_to(text=templates["italian"]["errors"]["search_usage"], message=m, parse_mode="html")
+        return
+    search.searches.set(m.user.id, query)
+    bot.send_chat_action(m.chat.id, "typing")
+    send_search_page(m, query, page=0, edit=False)
+
+
+@router.register("s.page")
+def search_page_change(call):
+    if not (query := search.searches.get(call.user.id)):
+        bot.answer_callback_query(call.id, text=templates["italian"]["errors"]["search_expired"], show_alert=True)
+        return
+    bot.answer_callback_query(call.id)
+    send_search_page(call, query, page=int(call.data), edit=True)
+
+
+@bot.inline_handler(func=lambda q: True)
+def inline_search(q):
+    results, next_offset = inline.answer(q.query, q.offset)
+    bot.answer_inline_query(q.id, results, cache_time=config.inline.cache_time, next_offset=next_offset)
+
+
+# endregion SEARCH
+
+
+@router.register("c.list")
 @bot.message_handler(commands=["lista"])
 @bot.message_handler(commands=["aggiungi"])
 @bot.message_handler(func=lambda m: m.text == templates["italian"]["keyboard"]["buttons"]["add"])
 @bot.message_handler(func=lambda m: m.text == templates["italian"]["keyboard"]["buttons"]["list"])
 def court_list(m):
-    with SessionFactory() as session:
-        User.update_by_id(session, id_=m.user.id, dct={"state": 0})
-        courts, count = Tracking.paginate(session, page=m.user.page, page_size=12)
-        try:
-            # if user pressed back button from court info
-            edit = bool(m.action)
-            call_answer = templates["italian"]["answers"]["back"]
-            bot.answer_callback_query(m.id, text=call_answer)
-        except AttributeError:
-            m.user.page = 0
-            User.update_by_id(session, id_=m.user.id, dct={"page": 0})
-            bot.send_chat_action(m.chat.id, "typing")
-            edit = False
+    users.update(m.user.id, {"state": 0})
+    try:
+        # if user pressed back button from court info
+        edit = bool(m.action)
+        call_answer = templates["italian"]["answers"]["back"]
+        bot.answer_callback_query(m.id, text=call_answer)
+    except AttributeError:
+        m.user.page = 0
+        users.update(m.user.id, {"page": 0})
+        bot.send_chat_action(m.chat.id, "typing")
+        edit = False
+    courts, count = catalog.page(page=m.user.page, page_size=markups.PAGE_SIZE)
+    with RoutingSessionFactory(info={"writer": m.user.id}) as session:
+        states = Tracking.get_states(session, user_id=m.user.id, court_ids=[c.id for c in courts])
     # c.info:town.info:c.list
     kb = markups.trackings_list(
-        courts=courts, count=count, action="c.info", back="c.list", page=m.user.page, user_id=m.user.id
+        courts=courts, count=count, action="c.info", back=callbacks.encode("c.list"), page=m.user.page, states=states
     )
     text = templates["italian"]["messages"]["court_add"]
     if edit:
@@ -324,34 +369,40 @@ def court_list(m):
         bot.send_message(text=text, chat_id=m.chat.id, reply_markup=kb)
 
 
-@bot.callback_query_handler(func=lambda call: True and call.action == "l.page")
+@router.register("l.page")
 def court_page_change(call):
     bot.answer_callback_query(call.id)
     if call.data == "next":
         call.user.page += 1
     elif call.data == "back":
         call.user.page -= 1
-    with SessionFactory() as session:
-        User.update_by_id(session, id_=call.user.id, dct={"page": call.user.page})
-        courts, count = Tracking.paginate(session, page=call.user.page, page_size=12)
+    users.update(call.user.id, {"page": call.user.page})
+    courts, count = catalog.page(page=call.user.page, page_size=markups.PAGE_SIZE)
+    with RoutingSessionFactory(info={"writer": call.user.id}) as session:
+        states = Tracking.get_states(session, user_id=call.user.id, court_ids=[c.id for c in courts])
     kb = markups.trackings_list(
-        courts=courts, count=count, action="c.info", back="c.list", page=call.user.page, user_id=call.user.id
+        courts=courts,
+        count=count,
+        action="c.info",
+        back=callbacks.encode("c.list"),
+        page=call.user.page,
+        states=states
     )
     bot.edit_message_reply_markup(chat_id=call.message.chat.id, message_id=call.message.id, reply_markup=kb)
 
 
-@bot.callback_query_handler(func=lambda call: call.action == "c.add")
+@router.register("c.add")
 def court_add_select(call):
-    with SessionFactory() as session:
+    with RoutingSessionFactory(info={"writer": call.user.id, "primary": True}) as session:
         court, is_dup = Tracking.create(session, user_id=call.user.id, court_id=call.data)
     text = templates["italian"]["messages"]["track_tlc"]
     bot.answer_callback_query(call.id, text=text, show_alert=True)
     court_info(call)
 
 
-@bot.callback_query_handler(func=lambda call: True and call.action == "c.delete")
+@router.register("c.delete")
 def court_delete(call):
-    with SessionFactory() as session:
+    with RoutingSessionFactory(info={"writer": call.user.id, "primary": True}) as session:
         result = Tracking.delete(session, user_id=call.user.id, court_id=call.data)
         court = session.get(Court, call.data)
     text = templates["italian"]["messages"]["court_delete"]
@@ -359,11 +410,10 @@ def court_delete(call):
     court_info(call)
 
 
-@bot.callback_query_handler(func=lambda call: True and call.action == "c.track-all")
-@bot.callback_query_handler(func=lambda call: True and call.action == "c.track-tlc")
+@router.register("c.track-all", "c.track-tlc")
 def court_update(call):
     new_state = call.action == "c.track-all"
-    with SessionFactory() as session:
+    with RoutingSessionFactory(info={"writer": call.user.id, "primary": True}) as session:
         Tracking.update(session, user_id=call.user.id, court_id=call.data, new_state=new_state)
         if new_state:
             court = session.get(Court, call.data)
@@ -374,6 +424,12 @@ def court_update(call):
     court_info(call)
 
 
+@bot.callback_query_handler(func=lambda call: True)
+def route_call(call):
+    if not router.dispatch(call):
+        bot.answer_callback_query(call.id)
+
+
 @bot.message_handler(func=lambda m: True)
 def error_handling(m):
     bot.reply_to(text=templates["italian"]["errors"]["generic"], message=m, parse_mode="html")
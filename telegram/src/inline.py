@@ -0,0 +1,88 @@
+import re
+
+from telebot import types
+
+from database.database import RoutingSessionFactory
+from database.models import Act
+from store.store import templates
+from telegram.config import TelegramConfig
+from telegram.src.cache import TTLCache
+from telegram.src.catalog import catalog
+
+config = TelegramConfig.from_environ()
+
+RE_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize(query: str) -> str:
+    """Same key for the same search, whatever the case or spacing typed by the user"""
+    return RE_WHITESPACE.sub(" ", query).strip().lower()
+
+
+def share_markup(uuid: str) -> types.InlineKeyboardMarkup:
+    kb = types.InlineKeyboardMarkup()
+    kb.add(
+        types.InlineKeyboardButton(
+            templates["italian"]["keyboard"]["inline_buttons"]["details"], url=config.main.deeplink.format(uuid)
+        )
+    )
+    return kb
+
+
+class InlineSearch():
+    """
+    Answers to inline queries, the newest acts of a court (when the query is a court name) or matching the query.
+    Queries arrive on every keystroke from every user typing the same words, so answers are kept in memory
+    by normalized query and offset for a short time, empty answers included.
+    """
+
+    def __init__(self, maxsize: int, ttl: int, min_length: int, page_size: int):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.min_length = min_length
+        self.page_size = page_size
+
+    def answer(self, query: str, offset: str):
+        """Results and next_offset of an inline query"""
+        query = normalize(query)
+        if len(query) < self.min_length:
+            return [], ""
+        page = int(offset) if offset.isdigit() else 0
+        key = (query, page)
+        if (answer := self.cache.get(key)) is None:
+            answer = self.load(query, page)
+            self.cache.set(key, answer)
+        return answer
+
+    def load(self, query: str, page: int):
+        court = catalog.find(query)
+        with RoutingSessionFactory() as session:
+            acts, total = Act.search(
+                session,
+                query=None if court else query,
+                court_id=court.id if court else None,
+                page=page,
+                page_size=self.page_size,
+                ranked=False,
+                load_info=True
+            )
+            results = [
+                types.InlineQueryResultArticle(
+                    id=a.uuid,
+                    title=f"TAR {a.court.name} - {a.date.strftime('%d/%m/%Y')}",
+                    description=a.text[:100],
+                    input_message_content=types.InputTextMessageContent(
+                        a.get_telegram_text(), parse_mode="html", disable_web_page_preview=True
+                    ),
+                    reply_markup=share_markup(a.uuid),
+                ) for a in acts
+            ]
+        next_offset = str(page + 1) if (page + 1) * self.page_size < total else ""
+        return results, next_offset
+
+
+inline = InlineSearch(
+    maxsize=config.cache.inline_size,
+    ttl=config.cache.inline_ttl,
+    min_length=config.inline.min_length,
+    page_size=config.inline.page_size
+)
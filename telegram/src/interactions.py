@@ -0,0 +1,109 @@
+import datetime as dt
+import queue
+import threading
+import time
+
+from sqlalchemy import insert
+
+from database.database import SessionFactory
+from database.models import Interaction, InteractionTypes, Platforms
+from logger.logger import log
+from telegram.config import TelegramConfig
+
+config = TelegramConfig.from_environ()
+
+# longer texts are truncated, the interactions are for analytics only
+MAX_TEXT_LENGTH = 500
+
+
+class InteractionRecorder():
+    """
+    Collects the interactions of the users in a bounded queue, a background thread writes them in batches
+    with multi-row inserts when batch_size events are waiting or flush_interval seconds have passed.
+    When the queue is full (e.g. the database is slow) new events are dropped and counted, never waited for.
+    """
+
+    def __init__(self, queue_size: int, batch_size: int, flush_interval: float):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.thread = None
+        self.running = threading.Event()
+        # record runs on every dispatcher thread
+        self.lock = threading.Lock()
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.role = "TG"
+
+    def start(self):
+        self.running.set()
+        self.thread = threading.Thread(target=self.work, name="interactions", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread:
+            self.thread.join()
+
+    def record(self, user_id: int, type_: InteractionTypes, text: str = None):
+        try:
+            self.queue.put_nowait(
+                {
+                    "platform": Platforms.telegram,
+                    "type": type_,
+                    "text": text[:MAX_TEXT_LENGTH] if text else text,
+                    "user_id": user_id,
+                    "timestamp": dt.datetime.now(dt.timezone.utc),
+                }
+            )
+            with self.lock:
+                self.recorded += 1
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def work(self):
+        while self.running.is_set() or not self.queue.empty():
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if batch:
+                self.flush(batch)
+
+    def flush(self, batch):
+        try:
+            with SessionFactory() as session:
+                session.execute(insert(Interaction).values(batch))
+                session.commit()
+            with self.lock:
+                self.written += len(batch)
+        except Exception:
+            with self.lock:
+                self.failed += len(batch)
+            log.exception(f"Error while saving {len(batch)} interactions", extra={"tag": self.role})
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "queued": self.queue.qsize(),
+                "recorded": self.recorded,
+                "written": self.written,
+                "dropped": self.dropped,
+                "failed": self.failed,
+            }
+
+
+recorder = InteractionRecorder(
+    queue_size=config.interactions.queue_size,
+    batch_size=config.interactions.batch_size,
+    flush_interval=config.interactions.flush_interval
+)
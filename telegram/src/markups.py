@@ -1,18 +1,18 @@
 # -*- coding: utf-8 -*-
 
 import math
-from typing import List, Union
+from typing import Dict, List, Union
 
-import requests
 from telebot import types
 
-from database.database import SessionFactory
-from database.models import Court, Tracking
+from database.models import Court
+from store.store import templates
 from telegram.config import TelegramConfig
+from telegram.src import callbacks
 
 config = TelegramConfig.from_environ()
 
-templates = requests.get(config.url.templates).json()
+PAGE_SIZE = 12
 
 
 def split_list(lst, n: int):
@@ -38,21 +38,21 @@ def act_info(act):
     btn_layout = [
         types.InlineKeyboardButton(
             templates["italian"]["keyboard"]["inline_buttons"]["court"],
-            callback_data=f"c.info:{act.court_id}:a.info:{act.uuid}",
+            callback_data=callbacks.encode("c.info", act.court_id, callbacks.encode("a.info", act.uuid)),
         )
     ]
     if act.info.has_docs:
         btn_layout.append(
             types.InlineKeyboardButton(
                 templates["italian"]["keyboard"]["inline_buttons"]["docs"],
-                callback_data=f"a.docs:{act.info.id}:a.info:{act.uuid}"
+                callback_data=callbacks.encode("a.docs", act.info.id, callbacks.encode("a.info", act.uuid))
             )
         )
     kb.add(*btn_layout)
     kb.add(
         types.InlineKeyboardButton(
             templates["italian"]["keyboard"]["inline_buttons"]["info"],
-            callback_data=f"a.extra:{act.uuid}:a.info:{act.uuid}"
+            callback_data=callbacks.encode("a.extra", act.uuid, callbacks.encode("a.info", act.uuid))
         )
     )
     return kb
@@ -64,27 +64,28 @@ def court_info(tracking, court_id, back: str = None):
         kb.add(
             types.InlineKeyboardButton(
                 templates["italian"]["keyboard"]["inline_buttons"]["delete"],
-                callback_data=f"c.delete:{court_id}:{back}"
+                callback_data=callbacks.encode("c.delete", court_id, back)
             )
         )
         if not tracking.track_all:
             kb.add(
                 types.InlineKeyboardButton(
                     templates["italian"]["keyboard"]["inline_buttons"]["track_all"],
-                    callback_data=f"c.track-all:{court_id}:{back}"
+                    callback_data=callbacks.encode("c.track-all", court_id, back)
                 )
             )
         else:
             kb.add(
                 types.InlineKeyboardButton(
                     templates["italian"]["keyboard"]["inline_buttons"]["track_tlc"],
-                    callback_data=f"c.track-tlc:{court_id}:{back}"
+                    callback_data=callbacks.encode("c.track-tlc", court_id, back)
                 )
             )
     else:
         kb.add(
             types.InlineKeyboardButton(
-                templates["italian"]["keyboard"]["inline_buttons"]["add"], callback_data=f"c.add:{court_id}:{back}"
+                templates["italian"]["keyboard"]["inline_buttons"]["add"],
+                callback_data=callbacks.encode("c.add", court_id, back)
             )
         )
     if back:
@@ -96,25 +97,21 @@ def court_info(tracking, court_id, back: str = None):
 
 # region TOWN
 def courts_list(
-    courts: List[Court], action: str, user_id, back: str = None, row_width: int = 2
+    courts: List[Court], action: str, states: Dict[str, bool], back: str = None, row_width: int = 2
 ) -> types.InlineKeyboardMarkup:
-    """ Generates an InlineKeyboard from a list of courts """
+    """ Generates an InlineKeyboard from a list of courts and the user's Tracking.get_states """
     kb = types.InlineKeyboardMarkup(row_width=row_width)
     btn_layout = []
-    with SessionFactory() as session:
-        for c in courts:
-            if court_tracking := session.get(Tracking, {"court_id": c.id, "user_id": user_id}):
-                emoji = "🟢" if court_tracking.track_all else "🟡"
-            else:
-                emoji = "🔴"
-            payload = f"{action}:{c.id}"
-            if back:
-                payload += f":{back}"
-            button = types.InlineKeyboardButton(f"{emoji} {c.name}", callback_data=payload)
-            btn_layout.append(button)
-        for b in list(split_list(btn_layout, row_width)):
-            kb.add(*b)
-        return kb
+    for c in courts:
+        if c.id in states:
+            emoji = "🟢" if states[c.id] else "🟡"
+        else:
+            emoji = "🔴"
+        button = types.InlineKeyboardButton(f"{emoji} {c.name}", callback_data=callbacks.encode(action, c.id, back))
+        btn_layout.append(button)
+    for b in list(split_list(btn_layout, row_width)):
+        kb.add(*b)
+    return kb
 
 
 def trackings_list(
@@ -122,32 +119,34 @@ def trackings_list(
     count,
     action: str,
     back: str,
-    user_id,
+    states: Dict[str, bool],
     page: int = 0,
 ) -> Union[bool, types.InlineKeyboardMarkup]:
     if not courts:
         return None
-    kb = courts_list(courts=courts, action=action, back=back, user_id=user_id)
-    last_page = int(math.ceil(count // 12))
+    kb = courts_list(courts=courts, action=action, back=back, states=states)
+    last_page = max(math.ceil(count / PAGE_SIZE) - 1, 0)
     if page == last_page and page == 0:
         return kb
     # print(f"page: {page} - len {last_page}")
     if page == 0:
         kb.add(
             types.InlineKeyboardButton(
-                templates["italian"]["keyboard"]["inline_buttons"]["p_next"], callback_data="l.page:next"
+                templates["italian"]["keyboard"]["inline_buttons"]["p_next"],
+                callback_data=callbacks.encode("l.page", "next")
             )
         )
     elif page == last_page:
         kb.add(
             types.InlineKeyboardButton(
-                templates["italian"]["keyboard"]["inline_buttons"]["p_back"], callback_data="l.page:back"
+                templates["italian"]["keyboard"]["inline_buttons"]["p_back"],
+                callback_data=callbacks.encode("l.page", "back")
             )
         )
     else:
         btn_layout = [
-            types.InlineKeyboardButton("◀️", callback_data="l.page:back"),
-            types.InlineKeyboardButton("▶️", callback_data="l.page:next:")
+            types.InlineKeyboardButton("◀️", callback_data=callbacks.encode("l.page", "back")),
+            types.InlineKeyboardButton("▶️", callback_data=callbacks.encode("l.page", "next"))
         ]
         kb.add(*btn_layout)
     return kb
@@ -156,6 +155,25 @@ def trackings_list(
 # endregion TOWN
 
 
+def search_results(results, first: int, page: int, pages: int) -> types.InlineKeyboardMarkup:
+    """ One button per result, numbered from first as in the message, and the page controls """
+    kb = types.InlineKeyboardMarkup(row_width=5)
+    kb.add(
+        *[
+            types.InlineKeyboardButton(str(n), callback_data=callbacks.encode("a.info", r.uuid))
+            for n, r in enumerate(results, start=first)
+        ]
+    )
+    btn_layout = []
+    if page > 0:
+        btn_layout.append(types.InlineKeyboardButton("◀️", callback_data=callbacks.encode("s.page", page - 1)))
+    if page < pages - 1:
+        btn_layout.append(types.InlineKeyboardButton("▶️", callback_data=callbacks.encode("s.page", page + 1)))
+    if btn_layout:
+        kb.add(*btn_layout)
+    return kb
+
+
 def inline_help() -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup(row_width=2)
     btn_help = types.InlineKeyboardButton(templates["italian"]["keyboard"]["buttons"]["help"], callback_data="help")
@@ -172,7 +190,9 @@ def force_reply():
 
 def list_keyboard() -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup(row_width=1)
-    btn_help = types.InlineKeyboardButton(templates["italian"]["keyboard"]["buttons"]["list"], callback_data="c.list")
+    btn_help = types.InlineKeyboardButton(
+        templates["italian"]["keyboard"]["buttons"]["list"], callback_data=callbacks.encode("c.list")
+    )
     kb.add(btn_help)
     return kb
 
@@ -0,0 +1,57 @@
+import datetime as dt
+import re
+from collections import namedtuple
+
+from database.database import RoutingSessionFactory
+from database.models import Act
+from telegram.config import TelegramConfig
+from telegram.src.cache import TTLCache
+from telegram.src.catalog import catalog
+
+config = TelegramConfig.from_environ()
+
+PAGE_SIZE = 5
+
+# tribunale:Milano dal:01/01/2022 al:31/12/2022, quotes for names with spaces
+RE_FILTERS = re.compile(r'\b(tribunale|dal|al):("[^"]*"|\S+)', re.IGNORECASE)
+
+SearchQuery = namedtuple("SearchQuery", ["text", "court_id", "since", "until"])
+SearchResult = namedtuple("SearchResult", ["uuid", "court_name", "date", "text"])
+
+
+def parse(arguments: str) -> SearchQuery:
+    """Splits the arguments of /cerca in the text to search and its filters, raises ValueError if invalid"""
+    filters = {}
+    for key, value in RE_FILTERS.findall(arguments or ""):
+        filters[key.lower()] = value.strip('"')
+    text = RE_FILTERS.sub(" ", arguments or "").strip()
+    if not text:
+        raise ValueError("Missing text to search")
+    court_id = None
+    if "tribunale" in filters:
+        if not (court := catalog.find(filters["tribunale"])):
+            raise ValueError(f"Unknown court {filters['tribunale']}")
+        court_id = court.id
+    since = dt.datetime.strptime(filters["dal"], "%d/%m/%Y").date() if "dal" in filters else None
+    until = dt.datetime.strptime(filters["al"], "%d/%m/%Y").date() if "al" in filters else None
+    return SearchQuery(text=text, court_id=court_id, since=since, until=until)
+
+
+def find(query: SearchQuery, page: int):
+    """Results in the page and the number of matches"""
+    with RoutingSessionFactory() as session:
+        acts, total = Act.search(
+            session,
+            query=query.text,
+            court_id=query.court_id,
+            since=query.since,
+            until=query.until,
+            page=page,
+            page_size=PAGE_SIZE
+        )
+        results = [SearchResult(uuid=a.uuid, court_name=a.court.name, date=a.date, text=a.text) for a in acts]
+    return results, total
+
+
+# last search of every user, callback data is too short to carry the query
+searches = TTLCache(maxsize=config.cache.searches_size, ttl=config.cache.searches_ttl)
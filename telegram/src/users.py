@@ -0,0 +1,104 @@
+import threading
+from contextlib import contextmanager
+
+from database.database import RoutingSessionFactory
+from database.models import User
+from logger.logger import log
+from telegram.config import TelegramConfig
+from telegram.src.cache import TTLCache
+
+config = TelegramConfig.from_environ()
+
+
+class UserCache():
+    """
+    Users of the bot kept in memory, the middlewares resolve known users without a query.
+    Every write made by the bot goes through update, anything changed elsewhere (e.g. a ban)
+    must call invalidate or is picked up when the entry expires.
+    Next to each user the cache keeps the values stored in the database, update only writes
+    the ones that differ and inside batch the writes for the same user are merged in one UPDATE.
+    """
+
+    def __init__(self, maxsize: int, ttl: int):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.local = threading.local()
+        self.writes = 0
+        self.skipped = 0
+        self.role = "TG"
+
+    def get_or_create(self, tg_user):
+        if entry := self.cache.get(tg_user.id):
+            return entry[0]
+        with RoutingSessionFactory(info={"writer": tg_user.id, "primary": True}) as session:
+            user = User.get_or_create(
+                session,
+                id=tg_user.id,
+                username=tg_user.username,
+                firstname=tg_user.first_name,
+                lastname=tg_user.last_name,
+                language=tg_user.language_code,
+            )
+            if user:
+                saved = {c.key: getattr(user, c.key) for c in User.__table__.columns}
+                self.cache.set(user.id, (user, saved))
+        return user
+
+    @contextmanager
+    def batch(self):
+        """Collects the updates made inside the block and writes them when it ends"""
+        self.local.pending = {}
+        try:
+            yield
+        finally:
+            pending, self.local.pending = self.local.pending, None
+            for user_id, changes in pending.items():
+                self.write(user_id, changes)
+
+    def update(self, user_id: int, dct) -> bool:
+        """Applies dct to the cached user, only values that differ from the stored ones are written"""
+        if entry := self.cache.get(user_id):
+            user, saved = entry
+            for k, v in dct.items():
+                setattr(user, k, v)
+            changes = {k: v for k, v in dct.items() if saved.get(k) != v}
+        else:
+            changes = dict(dct)
+        pending = getattr(self.local, "pending", None)
+        if pending is None:
+            return self.write(user_id, changes)
+        staged = pending.setdefault(user_id, {})
+        for k in dct:
+            # a value set back to the stored one cancels what was staged before
+            staged.pop(k, None)
+        staged.update(changes)
+        return True
+
+    def write(self, user_id: int, changes) -> bool:
+        if not changes:
+            self.skipped += 1
+            return True
+        with RoutingSessionFactory(info={"writer": user_id}) as session:
+            result = User.update_by_id(session, id_=user_id, dct=changes)
+        self.writes += 1
+        entry = self.cache.get(user_id)
+        if result and entry:
+            entry[1].update(changes)
+        elif entry:
+            self.invalidate(user_id)
+        return result
+
+    def stats(self) -> dict:
+        return {**self.cache.stats(), "writes": self.writes, "skipped": self.skipped}
+
+    def invalidate(self, user_id: int = None):
+        """Drops a user, or every user, from the cache"""
+        if user_id is None:
+            self.cache.clear()
+            log.info("Cleared user cache", extra={"tag": self.role})
+        else:
+            # ids come as text from the user_updated notifications
+            self.cache.pop(int(user_id))
+            log.info(f"Invalidated cached user {user_id}", extra={"tag": self.role})
+
+
+users = UserCache(maxsize=config.cache.users_size, ttl=config.cache.users_ttl)
@@ -0,0 +1,80 @@
+"""
+The database tests run on a scratch PostgreSQL database, TBOT_TEST_PSQL_DATABASE on the server of TBOT_PSQL_*.
+Its tables are created from scratch, without it those tests are skipped.
+"""
+import datetime as dt
+import os
+
+import pytest
+
+TEST_DATABASE = os.environ.get("TBOT_TEST_PSQL_DATABASE")
+
+# the configs are read on import, the values only matter for the database tests
+for name, value in {
+    "TBOT_PSQL_DATABASE": TEST_DATABASE or "test",
+    "TBOT_PSQL_USER": "postgres",
+    "TBOT_PSQL_PASSWORD": "",
+    "TBOT_PSQL_HOST": "localhost",
+    "TBOT_PSQL_PORT": "5432",
+    "TBOT_ACT_HASH_SECRET": "test",
+    "TBOT_TG_MAIN_DEEPLINK": "https://t.me/test?start={}",
+}.items():
+    os.environ.setdefault(name, value)
+os.environ["TBOT_PSQL_STRICT_QUERY_BUDGET"] = "true"
+
+from sqlalchemy import create_engine, text  # noqa: E402
+from sqlalchemy.orm import Session  # noqa: E402
+
+from database import database, migrations, models  # noqa: E402
+
+requires_db = pytest.mark.skipif(not TEST_DATABASE, reason="TBOT_TEST_PSQL_DATABASE is not set")
+
+
+@pytest.fixture(scope="session")
+def engine():
+    if not TEST_DATABASE:
+        pytest.skip("TBOT_TEST_PSQL_DATABASE is not set")
+    engine = create_engine(database.url.set(database=TEST_DATABASE), future=True)
+    models.Base.metadata.drop_all(engine)
+    models.Base.metadata.create_all(engine)
+    migrations.upgrade(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def session(engine):
+    with Session(engine, future=True, expire_on_commit=False) as session:
+        yield session
+    tables = ", ".join(f'"{t.name}"' for t in models.Base.metadata.sorted_tables if t.name != "schema_version")
+    with engine.begin() as conn:
+        conn.execute(text(f"TRUNCATE {tables} CASCADE"))
+
+
+@pytest.fixture
+def data(session):
+    """A court with two acts, a user tracking the court and a notification queued for each act"""
+
+    court = models.Court(id="058091", name="Roma", raw_name="TAR Roma")
+    user = models.User(id=1, username="user", firstname="Mario", lastname="Rossi")
+    session.add_all([court, user, models.Tracking(user=user, court=court, track_all=True)])
+    acts = []
+    for n in range(2):
+        act = models.Act(
+            uuid_hr=f"TAR/{n}/2022",
+            court=court,
+            text=f"Sentenza {n}",
+            full_text=f"Sentenza numero {n} sul ricorso proposto da un operatore telefonico",
+            date=dt.date(2022, 1, n + 1),
+            info=models.ActInfo(
+                docs=[models.Doc(url=f"https://example.com/{n}", type="web")],
+                extra_info={"sezione": "prima", "tipo": "sentenza"},
+            ),
+        )
+        session.add(act)
+        session.flush()
+        act.set_properties()
+        acts.append(act)
+    session.add_all([models.Message.from_act(act, text=act.text, reply_markup=None, user_id=user.id) for act in acts])
+    session.commit()
+    return {"court": court, "user": user, "acts": acts}
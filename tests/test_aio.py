@@ -0,0 +1,63 @@
+import asyncio
+
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from database import aio, models
+from tests.conftest import TEST_DATABASE, requires_db
+
+pytestmark = requires_db
+
+
+def run(coro_fn):
+    """Runs coro_fn(session) on an AsyncSession of the test database"""
+    async def main():
+        engine = create_async_engine(aio.url.set(database=TEST_DATABASE), future=True)
+        try:
+            async with AsyncSession(engine, expire_on_commit=False) as session:
+                return await coro_fn(session)
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(main())
+
+
+def test_user_aget_or_create(session, data):
+    user = run(lambda s: models.User.aget_or_create(s, id=data["user"].id))
+    assert user.username == data["user"].username
+    user = run(lambda s: models.User.aget_or_create(s, id=2, username="new"))
+    assert session.get(models.User, 2).username == "new"
+
+
+def test_tracking_twins(session, data):
+    court = models.Court(id="015146", name="Milano", raw_name="TAR Milano")
+    session.add(court)
+    session.commit()
+    user_id = data["user"].id
+
+    created, is_dup = run(lambda s: models.Tracking.acreate(s, user_id=user_id, court_id=court.id))
+    assert (created.id, is_dup) == (court.id, False)
+    _, is_dup = run(lambda s: models.Tracking.acreate(s, user_id=user_id, court_id=court.id))
+    assert is_dup
+
+    court_ids = [court.id, data["court"].id]
+    states = run(lambda s: models.Tracking.aget_states(s, user_id=user_id, court_ids=court_ids))
+    assert states == models.Tracking.get_states(session, user_id=user_id, court_ids=court_ids)
+    courts = run(lambda s: models.Tracking.aget_by_user(s, user_id=user_id))
+    assert {c.id for c in courts} == {c.id for c in models.Tracking.get_by_user(session, user_id=user_id)}
+
+    run(lambda s: models.Tracking.aupdate(s, user_id=user_id, court_id=court.id, new_state=True))
+    assert run(lambda s: models.Tracking.aget(s, user_id=user_id, court_id=court.id)).track_all
+
+    assert run(lambda s: models.Tracking.adelete(s, user_id=user_id, court_id=court.id))
+    assert not run(lambda s: models.Tracking.adelete(s, user_id=user_id, court_id=court.id))
+    session.expire_all()
+    assert models.CourtStats.get(session, court.id).user_count == 0
+
+
+def test_act_and_docs_twins(session, data):
+    act = data["acts"][0]
+    loaded = run(lambda s: models.Act.aget_by_uuid(s, uuid=act.uuid))
+    # the bot card is loaded with the act, nothing is lazy loaded after the session is gone
+    assert (loaded.id, loaded.court.name, loaded.info.has_docs) == (act.id, "Roma", True)
+    docs = run(lambda s: models.Doc.aget_by_info_id(s, info_id=act.info_id))
+    assert [d.id for d in docs] == [d.id for d in models.Doc.get_by_info_id(session, info_id=act.info_id)]
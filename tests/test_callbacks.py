@@ -0,0 +1,63 @@
+import pytest
+
+from telegram.src import callbacks
+
+
+def back_chain(payload):
+    """Actions and data of the screens the back buttons of a payload go through"""
+    chain = []
+    while payload:
+        action, data, payload = callbacks.decode(payload)
+        chain.append((action, data))
+    return chain
+
+
+def test_round_trip():
+    for action in callbacks.CODES:
+        assert callbacks.decode(callbacks.encode(action, "058091")) == (action, "058091", None)
+    assert callbacks.decode(callbacks.encode("l.page")) == ("l.page", None, None)
+    assert callbacks.decode(callbacks.encode("s.page", 3)) == ("s.page", "3", None)
+
+
+def test_back_chain():
+    page = callbacks.encode("c.list", 2)
+    court = callbacks.encode("c.info", "058091", back=page)
+    act = callbacks.encode("a.info", "abc", back=court)
+    assert act == "1iabc/c058091/l2"
+    action, data, back = callbacks.decode(act)
+    assert (action, data, back) == ("a.info", "abc", court)
+    assert back_chain(act) == [("a.info", "abc"), ("c.info", "058091"), ("c.list", "2")]
+
+
+def test_truncation_drops_the_oldest_frames():
+    payload = None
+    for n in range(20):
+        payload = callbacks.encode("c.info", f"{n:06d}", back=payload)
+    assert len(payload.encode()) <= callbacks.MAX_SIZE
+    chain = back_chain(payload)
+    # the version, 7 bytes per frame and a separator between them: 8 frames fit
+    assert len(chain) == 8
+    assert chain == [("c.info", f"{n:06d}") for n in range(19, 19 - len(chain), -1)]
+
+
+def test_invalid_data():
+    with pytest.raises(ValueError):
+        callbacks.encode("c.info", "a/b")
+    with pytest.raises(ValueError):
+        callbacks.encode("a.info", "x" * callbacks.MAX_SIZE)
+
+
+def test_legacy_payloads():
+    assert callbacks.decode("a.info:abc") == ("a.info", "abc", None)
+    assert callbacks.decode("a.info:abc:None") == ("a.info", "abc", None)
+    assert callbacks.decode("l.page") == ("l.page", None, None)
+    assert callbacks.decode("c.track-all:058091|1") == ("c.track-all", ["058091", "1"], None)
+    assert callbacks.decode("a.info:abc:c.info:058091:c.list:2") == ("a.info", "abc", "c.info:058091:c.list:2")
+
+
+def test_legacy_back_chain_is_converted():
+    payload = callbacks.encode("a.docs", "abc", back="c.info:058091:c.list:2")
+    assert payload == "1dabc/c058091/l2"
+    # frames with list data or unknown actions can't be converted, the chain stops there
+    assert callbacks.encode("a.docs", "abc", back="c.track-all:058091|1") == "1dabc"
+    assert callbacks.encode("a.docs", "abc", back="unknown:1") == "1dabc"
@@ -0,0 +1,86 @@
+import random
+
+from telegram.src import flood
+
+
+def test_window_duplicates():
+    window = flood.UpdateWindow(16)
+    assert not window.seen(10)
+    assert window.seen(10)
+    # out of order, but inside the window
+    assert not window.seen(8)
+    assert window.seen(8)
+    assert window.duplicates == 2
+
+
+def test_window_older_ids_are_seen():
+    window = flood.UpdateWindow(16)
+    window.seen(100)
+    assert window.seen(84)
+    assert not window.seen(85)
+
+
+def test_window_wrap_clears_the_reused_bits():
+    window = flood.UpdateWindow(16)
+    assert not window.seen(21)
+    assert not window.seen(36)
+    # 21 is still in the window, its bit is not reused yet
+    assert window.seen(21)
+    # 37 takes the bit of 21
+    assert not window.seen(37)
+    # a jump longer than the window clears everything
+    assert not window.seen(100)
+    assert not window.seen(85)
+
+
+def test_window_matches_a_set():
+    rnd = random.Random(1)
+    size = 64
+    window, received, highest = flood.UpdateWindow(size), set(), None
+    for n in range(5000):
+        update_id = n + rnd.randint(-size - 10, 5) if rnd.random() < 0.3 else n
+        if highest is None:
+            highest = update_id
+        expected = update_id in received or update_id <= highest - size
+        assert window.seen(update_id) == expected, update_id
+        received.add(update_id)
+        highest = max(highest, update_id)
+
+
+def test_window_forget():
+    window = flood.UpdateWindow(16)
+    window.forget(5)
+    assert not window.seen(5)
+    window.forget(5)
+    assert not window.seen(5)
+    window.seen(50)
+    # out of the window, still considered seen
+    window.forget(5)
+    assert window.seen(5)
+
+
+def test_rate_limiter_refill(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(flood.time, "monotonic", lambda: now[0])
+    limiter = flood.RateLimiter(rate=1, burst=2, maxsize=10)
+    assert [limiter.allow(1) for _ in range(3)] == [True, True, False]
+    now[0] = 0.5
+    assert not limiter.allow(1)
+    now[0] = 1.0
+    assert limiter.allow(1)
+    # never more than burst tokens
+    now[0] = 100.0
+    assert [limiter.allow(1) for _ in range(3)] == [True, True, False]
+    assert (limiter.allowed, limiter.limited) == (5, 3)
+
+
+def test_rate_limiter_forgets_the_least_recent_users(monkeypatch):
+    monkeypatch.setattr(flood.time, "monotonic", lambda: 0.0)
+    limiter = flood.RateLimiter(rate=1, burst=1, maxsize=2)
+    limiter.allow(1)
+    limiter.allow(2)
+    limiter.allow(1)
+    limiter.allow(3)
+    assert list(limiter.buckets) == [1, 3]
+    # a forgotten user starts again with a full bucket
+    assert limiter.allow(2)
@@ -0,0 +1,16 @@
+from database import migrations, models
+from tests.conftest import requires_db
+
+pytestmark = requires_db
+
+
+def test_hot_queries_use_their_index(engine):
+    assert all(migrations.check_indexes(engine).values())
+
+
+def test_sort_over_the_index_fails(engine, monkeypatch):
+    Message = models.Message
+    # the order of the queue before the fair queue, the index only filters the unsent messages
+    stmt = Message.get_queue_stmt(limit=50).order_by(None).order_by(Message.priority.desc(), Message.timestamp)
+    monkeypatch.setattr(migrations, "hot_queries", lambda: {"ix_messages_queue": stmt})
+    assert migrations.check_indexes(engine) == {"ix_messages_queue": False}
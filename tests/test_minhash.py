@@ -0,0 +1,63 @@
+import zlib
+
+from sherlock.src import minhash
+
+
+def hashes(words) -> set:
+    """Shingle hashes of as many distinct words"""
+    return {zlib.crc32(f"parola{i}".encode("utf-8")) for i in words}
+
+
+def test_shingles():
+    text = "Il Tribunale di Roma dispone la vendita dell'immobile"
+    assert minhash.shingles(text) == minhash.shingles(text.upper().replace(" ", " ,  "))
+    words = len(minhash.RE_WORD.findall(text))
+    assert len(minhash.shingles(text)) == words - minhash.SHINGLE_SIZE + 1
+    # shorter than a shingle
+    assert len(minhash.shingles("Tribunale di Roma")) == 1
+    assert minhash.shingles("") == set()
+
+
+def test_signature():
+    sig = minhash.signature(hashes(range(100)))
+    assert len(sig) == minhash.NUM_PERM
+    assert sig == minhash.signature(hashes(range(100)))
+    assert all(0 <= h <= minhash.MAX_HASH for h in sig)
+    assert minhash.signature(set()) == []
+    assert minhash.fingerprint(None) == []
+
+
+def test_bands():
+    sig = minhash.signature(hashes(range(100)))
+    buckets = minhash.bands(sig)
+    assert len(buckets) == minhash.BANDS == minhash.NUM_PERM // minhash.ROWS
+    assert all(-2**63 <= b < 2**63 for b in buckets)
+    # a different row only moves the bucket of its band
+    other = list(sig)
+    other[0] += 1
+    changed = [a != b for a, b in zip(buckets, minhash.bands(other))]
+    assert changed == [True] + [False] * (minhash.BANDS - 1)
+
+
+def test_similarity():
+    sig = minhash.signature(hashes(range(1000)))
+    assert minhash.similarity(sig, sig) == 1.0
+    assert minhash.similarity(sig, []) == 0.0
+    assert minhash.similarity(sig, minhash.signature(hashes(range(1000, 2000)))) < 0.1
+    # Jaccard similarity 0.8
+    estimate = minhash.similarity(sig, minhash.signature(hashes(range(111, 1111))))
+    assert abs(estimate - 0.8) < 0.15
+
+
+def test_similar_texts_share_a_band():
+    words = [f"parola{i}" for i in range(200)]
+    text = " ".join(words)
+    edited = " ".join(words[:100] + ["modificata"] + words[101:])
+    assert set(minhash.bands(minhash.fingerprint(text))) & set(minhash.bands(minhash.fingerprint(edited)))
+
+
+def test_pack():
+    sig = minhash.signature(hashes(range(100)))
+    assert minhash.unpack(minhash.pack(sig)) == sig
+    assert minhash.unpack(None) == []
+    assert minhash.unpack(minhash.pack(sig[:8])) == []
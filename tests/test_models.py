@@ -0,0 +1,37 @@
+from sqlalchemy import func
+from sqlalchemy.future import select
+
+from database import models
+from tests.conftest import requires_db
+
+pytestmark = requires_db
+
+
+def test_search_vector_follows_act_text(session, data):
+    act = data["acts"][0]
+    query = func.plainto_tsquery("italian", "ippopotamo")
+    stmt = select(models.ActText.act_id).where(models.ActText.search_vector.op("@@")(query))
+    assert session.execute(stmt).scalars().all() == []
+    # as Sherlock's clean does, the body is untouched
+    act.text = f"{act.text} ippopotamo"
+    session.flush()
+    assert session.execute(stmt).scalars().all() == [act.id]
+
+
+def test_premium_recipients_skip_the_broadcast(session, data):
+    act = data["acts"][0]
+    regular = [models.Message.from_act(act, text="", reply_markup="", user_id=1) for _ in range(5)]
+    premium = models.Message.from_act(
+        act, text="", reply_markup="", user_id=1, priority=models.MessagePriorities.premium
+    )
+    session.add_all(regular + [premium])
+    session.flush()
+    # the premium flow of the act starts with the current virtual time, not after the regular recipients
+    assert premium.finish < min(msg.finish for msg in regular)
+    queue = [msg.id for msg in models.Message.get_queue(session, limit=10)]
+    assert queue.index(premium.id) < min(queue.index(msg.id) for msg in regular)
+
+
+def test_act_search(session, data):
+    acts, total = models.Act.search(session, query="ricorso operatore", since=data["acts"][1].date)
+    assert ([a.id for a in acts], total) == ([data["acts"][1].id], 1)
@@ -0,0 +1,74 @@
+import pytest
+from sqlalchemy.future import select
+
+from database import models
+from database.budget import QueryBudgetExceeded, query_budget
+from database.loaders import options
+from tests.conftest import requires_db
+
+pytestmark = requires_db
+
+
+def test_strict_budget_raises():
+    with pytest.raises(QueryBudgetExceeded):
+        with query_budget("Test", 0) as statements:
+            statements.append("SELECT 1")
+
+
+def test_lazy_loads_go_over_budget(session, data):
+    session.expunge_all()
+    with pytest.raises(QueryBudgetExceeded):
+        with query_budget("Acts without profile", 1):
+            for act in session.execute(select(models.Act)).scalars():
+                act.court.name
+
+
+def test_bot_card(session, data):
+    session.expunge_all()
+    with query_budget("Act card", 1) as statements:
+        act = models.Act.get_by_uuid(session, uuid=data["acts"][0].uuid)
+        # what the card renders
+        act.court.name, act.date, act.info.extra_info, act.info.isp, act.info.has_docs
+    assert len(statements) == 1
+
+
+def test_sherlock_batch(session, data):
+    session.expunge_all()
+    stmt = models.Act.get_queue_stmt(limit=10).options(*options("sherlock_batch"))
+    with query_budget("Sherlock batch", 3) as statements:
+        acts = session.execute(stmt).scalars().all()
+    # acts, their text and their docs
+    assert len(statements) == 3
+    assert len(acts) == 2
+    with query_budget("Sherlock act", 0):
+        for act in acts:
+            act.full_text, act.court.name, act.info.extra_info, act.info.has_docs, [d.url for d in act.info.docs]
+
+
+def test_postman_send(session, data):
+    for msg in session.execute(select(models.Message)).scalars():
+        msg.reply_markup = "{}"
+    session.commit()
+    session.expunge_all()
+    with query_budget("Postman queue", 1) as statements:
+        messages = models.Message.get_queue(session, limit=10)
+    assert len(statements) == 1
+    assert len(messages) == 2
+    # the payload is stored with the messages, their acts are never loaded
+    with query_budget("Postman render", 0):
+        models.Message.load_render_acts(session, messages)
+        for msg in messages:
+            msg.render()
+
+
+def test_postman_render_legacy(session, data):
+    session.expunge_all()
+    messages = models.Message.get_queue(session, limit=10)
+    # queued without a keyboard, their acts are loaded at once
+    with query_budget("Postman render", 1) as statements:
+        models.Message.load_render_acts(session, messages)
+    assert len(statements) == 1
+    with query_budget("Postman render", 0):
+        for msg in messages:
+            # what render needs
+            msg.act.get_deeplink(), msg.act.info.has_docs
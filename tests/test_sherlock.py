@@ -0,0 +1,110 @@
+import datetime as dt
+
+import pytest
+from sqlalchemy import func
+from sqlalchemy.future import select
+from sqlalchemy.orm import sessionmaker
+
+from database import models
+from database.budget import query_budget
+from sherlock.src import _sherlock, minhash
+from tests.conftest import requires_db
+
+pytestmark = requires_db
+
+
+@pytest.fixture
+def sherlock(engine, monkeypatch):
+    """A Sherlock whose own sessions are on the test database"""
+    monkeypatch.setattr(_sherlock, "SessionFactory", sessionmaker(bind=engine, future=True, expire_on_commit=False))
+    return _sherlock.Sherlock(
+        keywords={"whitelist": [], "blacklist": [], "isp": [], "exact": []},
+        config_poll_time=10,
+        batch_size=10,
+        chunk_size=1,
+        dedup_threshold=0.8,
+        dedup_days=30,
+        tg_channel_id=0,
+    )
+
+
+def test_act_queue_keyset(session, data):
+    first, second = sorted(data["acts"], key=lambda a: (a.timestamp, a.id))
+    acts = session.execute(models.Act.get_queue_stmt(limit=10, after=(first.timestamp, first.id))).scalars().all()
+    assert [a.id for a in acts] == [second.id]
+
+
+def test_failed_act_is_isolated(session, data, sherlock, monkeypatch):
+    first, second = sorted(data["acts"], key=lambda a: (a.timestamp, a.id))
+    session.commit()
+
+    def process(session, act):
+        act.processed_at = dt.datetime.now()
+        if act.id == first.id:
+            raise ValueError("broken act")
+
+    monkeypatch.setattr(sherlock, "process", process)
+    assert sherlock.process_batch() == 2
+    session.expire_all()
+    first, second = session.get(models.Act, first.id), session.get(models.Act, second.id)
+    # the failed act is rolled back and marked, the other one is committed with its own chunk
+    assert first.processed_at is None and "broken act" in first.error
+    assert second.processed_at is not None and second.error is None
+
+
+def test_failed_duplicate_check_is_skipped(session, data, sherlock, monkeypatch):
+    def fingerprint(text):
+        raise ValueError("broken fingerprint")
+
+    act = data["acts"][0]
+    monkeypatch.setattr(minhash, "fingerprint", fingerprint)
+    sherlock.process(session, act)
+    session.commit()
+    assert act.processed_at is not None and act.error is None
+
+
+def test_index_fingerprints(session, data, sherlock):
+    for act in data["acts"]:
+        act.processed_at = dt.datetime.now()
+    session.add(models.Act(
+        uuid_hr="TAR/2/2022",
+        court=data["court"],
+        text="Sentenza 2",
+        full_text="Sentenza numero 2",
+        date=dt.date(2022, 1, 3),
+        processed_at=dt.datetime.now(),
+        info=models.ActInfo(),
+    ))
+    session.commit()
+    sherlock.dedup_days = (dt.date.today() - dt.date(2022, 1, 2)).days
+    # nothing to do until the pruning starts a pass
+    assert sherlock.index_fingerprints() == 0
+    sherlock.prune_fingerprints()
+    # a chunk per call
+    assert [sherlock.index_fingerprints() for _ in range(3)] == [1, 1, 0]
+    assert sherlock.index_after is None
+    rows = session.execute(select(models.ActFingerprint.act_id, func.count()).group_by("act_id")).all()
+    # only the acts since the date
+    assert sorted(rows) == sorted((act.id, minhash.BANDS) for act in session.query(models.Act).filter(
+        models.Act.date >= dt.date(2022, 1, 2)
+    ))
+    signature = session.get(models.ActText, data["acts"][1].id).signature
+    assert minhash.unpack(signature) == minhash.fingerprint(data["acts"][1].full_text)
+
+
+def test_duplicate_from_stored_signature(session, data, sherlock):
+    first, second = data["acts"]
+    second.full_text = first.full_text
+    session.commit()
+    sherlock.process(session, first)
+    session.commit()
+    session.expunge_all()
+    second = session.get(models.Act, second.id)
+    second.full_text, second.info
+    sherlock.act = second
+    # candidates with their signature, the duplicate flag flushed, buckets and signature of the act
+    with query_budget("Duplicate check", 4) as statements:
+        sherlock.check_duplicate(session)
+    assert second.info.duplicate_of == first.id
+    # the text of the candidate is never loaded
+    assert not any(s.startswith("SELECT acts_text") for s in statements)